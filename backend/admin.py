@@ -2,13 +2,16 @@ import logging
 from datetime import timedelta, datetime
 
 import jwt
-from fastapi import Body, APIRouter, HTTPException, Depends
+from fastapi import Body, APIRouter, HTTPException, Depends, Request
 from fastapi.security import OAuth2PasswordBearer
 from jwt import InvalidTokenError
 from pydantic import BaseModel
+from redis.exceptions import RedisError
 from sqlalchemy import select
 from starlette import status
 
+import passwords
+from cache import redis
 from database import async_session
 from database.models import Admin
 from env import ServerKeys
@@ -17,6 +20,11 @@ logger = logging.getLogger(__name__)
 
 admin_router = APIRouter(prefix='/api/admin', tags=['admin'])
 
+# Ограничение попыток входа в окне LOGIN_WINDOW секунд
+LOGIN_WINDOW = 15 * 60
+LOGIN_ATTEMPTS_PER_USERNAME = 5
+LOGIN_ATTEMPTS_PER_IP = 20
+
 
 class AdminLogin(BaseModel):
     username: str
@@ -43,29 +51,78 @@ async def get_current_admin(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
 
 
+def login_attempt_keys(username: str, ip: str) -> tuple[str, str]:
+    return f'admin_login:username:{username}', f'admin_login:ip:{ip}'
+
+
+async def check_login_attempts(username: str, ip: str):
+    """Считает попытку входа и отклоняет запрос, если попыток слишком много - до проверки пароля."""
+    username_key, ip_key = login_attempt_keys(username, ip)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.incr(username_key)
+            pipe.expire(username_key, LOGIN_WINDOW, nx=True)
+            pipe.incr(ip_key)
+            pipe.expire(ip_key, LOGIN_WINDOW, nx=True)
+            username_attempts, _, ip_attempts, _ = await pipe.execute()
+    except RedisError as e:
+        logger.error(f"Не удалось проверить число попыток входа: {e!r}")
+        return
+
+    if username_attempts > LOGIN_ATTEMPTS_PER_USERNAME or ip_attempts > LOGIN_ATTEMPTS_PER_IP:
+        logger.warning(f"Слишком много попыток входа: username={username}, ip={ip}")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts",
+            headers={"Retry-After": str(LOGIN_WINDOW)},
+        )
+
+
+async def reset_login_attempts(username: str, ip: str):
+    username_key, _ = login_attempt_keys(username, ip)
+    try:
+        await redis.delete(username_key)
+    except RedisError as e:
+        logger.error(f"Не удалось сбросить число попыток входа: {e!r}")
+
+
 @admin_router.post("/login")
-async def admin_login(form_data: AdminLogin = Body(...)):
+async def admin_login(request: Request, form_data: AdminLogin = Body(...)):
+    ip = request.client.host if request.client else 'unknown'
+    await check_login_attempts(form_data.username, ip)
+
     async with async_session() as session:
         query = select(Admin).where(Admin.username == form_data.username)
         result = await session.execute(query)
         admin = result.scalar_one_or_none()
 
-        if not admin or not admin.check_password(form_data.password):
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Incorrect username or password",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-
-        if not admin.is_active:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin is inactive")
-
-        # Генерация JWT (аналогично вашему /api/auth, но с role)
-        token_expires = timedelta(hours=24)
-        token = jwt.encode({
-            'sub': admin.username,  # Или admin.id
-            'role': 'admin',
-            'exp': datetime.now() + token_expires
-        }, ServerKeys.JWT_SECRET_KEY, algorithm='HS256')
-
-        return {"access_token": token, "token_type": "bearer"}
+    try:
+        password_ok = await passwords.check_password(form_data.password, admin.password_hash if admin else None)
+    except passwords.PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login requests, try again later",
+            headers={"Retry-After": "1"},
+        )
+
+    if not password_ok:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    if not admin.is_active:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin is inactive")
+
+    await reset_login_attempts(form_data.username, ip)
+
+    # Генерация JWT (аналогично вашему /api/auth, но с role)
+    token_expires = timedelta(hours=24)
+    token = jwt.encode({
+        'sub': admin.username,  # Или admin.id
+        'role': 'admin',
+        'exp': datetime.now() + token_expires
+    }, ServerKeys.JWT_SECRET_KEY, algorithm='HS256')
+
+    return {"access_token": token, "token_type": "bearer"}
@@ -1,40 +1,112 @@
+import asyncio
 import hashlib
 import hmac
 import json
 import logging
 import re
 import urllib
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, date
 from decimal import Decimal
+from functools import cache
+from ipaddress import ip_address, ip_network
 from operator import itemgetter
-from typing import Optional, Any, List
-from urllib.parse import unquote
+from typing import Optional, Any, List, Literal, Dict
+from urllib.parse import unquote, urlparse
+from uuid import uuid4
 
 import jwt
-from fastapi import FastAPI, HTTPException, Body, Request, Security
+from fastapi import FastAPI, HTTPException, Body, Request, Security, Header, Query, BackgroundTasks
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, field_validator
 from redis.asyncio import Redis
-from sqlalchemy import select, delete
-from starlette.responses import JSONResponse
-from yookassa import Payment, Configuration
-
+from redis.exceptions import RedisError
+from sqlalchemy import Select, select, delete, update, tuple_, func, or_, literal, union_all, and_, any_, bindparam, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+import cart_store
+import idempotency
+import launches
+import payment_events
+import reminders
 from admin import admin_router, get_current_admin
+from cache import redis
+from catalog import CatalogCache, CatalogSnapshot, etag_matches
 from database import async_session
-from database.models import User, Product, Order, CartItem, Transaction, Delivery, UserActionLog, Source, SourceVisit
+from database.models import User, Product, Order, OrderItem, CartItem, Transaction, Delivery, UserActionLog, Source, \
+    SourceVisit
 from database.models.cart_item import CartItemType
+from database.models.user import USER_SORT_KEYS
 from env import ServerKeys, YookassaKeys, RedisKeys
+from export import export_router
+from images import ImageService, ImmutableStaticFiles
+from order_items import order_item_rows, order_items_out
+from pricing import PricingError, price_order
+from pagination import NEXT_CURSOR_HEADER, TOTAL_COUNT_ESTIMATE_HEADER, encode_cursor, decode_cursor, estimate_table_rows
+from payments import YookassaClient, CreatedPayment, PaymentGatewayError, PaymentGatewayUnavailable
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-app.include_router(admin_router)
 
-# --- настройки ЮКасса ---
-Configuration.account_id = YookassaKeys.SHOP_ID
-Configuration.secret_key = YookassaKeys.SECRET_KEY
+images = ImageService(ServerKeys.MEDIA_ROOT, ServerKeys.MEDIA_URL)
+payment_gateway = YookassaClient(YookassaKeys.SHOP_ID, YookassaKeys.SECRET_KEY, YookassaKeys.API_URL)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await images.start()
+    await payment_gateway.start()
+
+    # Прогреваем каталог, чтобы первые запросы после деплоя не шли в Postgres
+    try:
+        await catalog.get()
+    except Exception as e:
+        logger.error(f"Не удалось прогреть кэш каталога: {e!r}")
+
+    catalog_listener = asyncio.create_task(catalog.listen())
+    launch_counter = asyncio.create_task(launches.run())
+    delivery_reminders = asyncio.create_task(reminders.run())
+    cart_writer = asyncio.create_task(cart_store.run())
+    payment_event_worker = asyncio.create_task(payment_events.run(apply_payment_event))
+    try:
+        yield
+    finally:
+        catalog_listener.cancel()
+        launch_counter.cancel()
+        delivery_reminders.cancel()
+        cart_writer.cancel()
+        payment_event_worker.cancel()
+        # Дожидаемся остановки задач, чтобы ни одна не обращалась к Redis после его закрытия
+        await asyncio.gather(
+            catalog_listener, launch_counter, delivery_reminders, cart_writer, payment_event_worker,
+            return_exceptions=True
+        )
+        try:
+            await launches.flush()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить счётчики запусков при остановке: {e!r}")
+        try:
+            await cart_store.flush()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить корзины при остановке: {e!r}")
+        await images.close()
+        await payment_gateway.close()
+        await redis.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(admin_router)
+app.include_router(export_router)
+app.mount(
+    urlparse(ServerKeys.MEDIA_URL).path,
+    ImmutableStaticFiles(directory=ServerKeys.MEDIA_ROOT, check_dir=False),
+    name="media"
+)
 
 # Разрешаем CORS для фронта
 app.add_middleware(
@@ -43,6 +115,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, TOTAL_COUNT_ESTIMATE_HEADER],
 )
 
 if ServerKeys.DEBUG:
@@ -175,6 +248,14 @@ class AuthData(BaseModel):
     initData: str
 
 
+@cache
+def webapp_secret_key() -> bytes:
+    """Ключ для проверки подписи WebAppInitData зависит только от токена бота - считаем один раз."""
+    return hmac.new(
+        key=b"WebAppData", msg=ServerKeys.TG_API_TOKEN.encode(), digestmod=hashlib.sha256
+    ).digest()
+
+
 async def verify_init_data(init_data: str) -> dict:
     try:
         parsed_data = dict(urllib.parse.parse_qsl(init_data, keep_blank_values=True))
@@ -186,16 +267,17 @@ async def verify_init_data(init_data: str) -> dict:
     data_check_string = "\n".join(
         f"{k}={v}" for k, v in sorted(parsed_data.items(), key=itemgetter(0))
     )
-    secret_key = hmac.new(
-        key=b"WebAppData", msg=ServerKeys.TG_API_TOKEN.encode(), digestmod=hashlib.sha256
-    )
     computed_hash = hmac.new(
-        key=secret_key.digest(), msg=data_check_string.encode(), digestmod=hashlib.sha256
+        key=webapp_secret_key(), msg=data_check_string.encode(), digestmod=hashlib.sha256
     ).hexdigest()
-    if computed_hash != received_hash:
+    # Байты, а не строки: compare_digest падает с TypeError на не-ASCII строках из запроса
+    if not hmac.compare_digest(computed_hash.encode(), received_hash.encode()):
         raise HTTPException(status_code=401, detail="Invalid WebAppInitData")
 
-    auth_date = int(parsed_data.get('auth_date', 0))
+    try:
+        auth_date = int(parsed_data.get('auth_date', 0))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid auth_date")
     if (datetime.now().timestamp() - auth_date) > 300 and not ServerKeys.DEBUG:
         raise HTTPException(status_code=401, detail="Expired WebAppInitData")
     user_field = parsed_data.get('user')
@@ -216,25 +298,32 @@ async def auth(data: AuthData = Body(...)):
     try:
         user_data = await verify_init_data(data.initData)
         photo_url = user_data.get("photo_url")
+        # Создание или обновление аватара одним запросом; аватар пишется, только если он изменился.
+        # Если строка не менялась, RETURNING пуст - тогда blocked читаем из таблицы в том же запросе
+        upsert = insert(User).values(
+            user_id=user_data["id"],
+            avatar=photo_url,
+            phone_number=user_data.get("phone_number"),
+            join_time=datetime.now(),
+            first_name=user_data.get("first_name"),
+            last_name=user_data.get("last_name"),
+        )
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={"avatar": upsert.excluded.avatar},
+            where=User.avatar.is_distinct_from(upsert.excluded.avatar),
+        ).returning(User.blocked).cte("upsert")
+        query = union_all(
+            select(upsert.c.blocked),
+            select(User.blocked).where(User.user_id == user_data["id"], ~select(upsert).exists()),
+        )
         async with async_session() as session:
-            query = select(User).where(User.user_id == user_data["id"])
             result = await session.execute(query)
-            user = result.scalar_one_or_none()
-            if user:
-                user.avatar = photo_url
-                if getattr(user, "blocked", False):
-                    raise HTTPException(status_code=403, detail="Вы были заблокированы - обратитесь к администратору")
-            else:
-                user = User(
-                    user_id=user_data["id"],
-                    avatar=photo_url,
-                    phone_number=user_data.get("phone_number"),
-                    join_time=datetime.now(),
-                    first_name=user_data.get("first_name"),
-                    last_name=user_data.get("last_name"),
-                )
-                session.add(user)
+            blocked = result.scalar()
             await session.commit()
+        if blocked:
+            raise HTTPException(status_code=403, detail="Вы были заблокированы - обратитесь к администратору")
+        await launches.record_launch(user_data["id"])
         token = jwt.encode({
             'user_id': user_data['id'],
             'exp': datetime.now() + timedelta(hours=24)
@@ -258,37 +347,180 @@ class ProductIn(BaseModel):
 
 class ProductOut(ProductIn):
     id: int
+    thumbnails: List[Optional[Dict[str, Dict[str, str]]]] = []  # Превью для каждого фото из photos: {ширина: {формат: url}}
+
+
+def product_to_out(p: Product) -> ProductOut:
+    photos = p.photos or []
+    thumbnails = p.thumbnails or {}
+    return ProductOut(
+        id=p.id,
+        title=p.title,
+        description=p.description,
+        photos=photos,
+        thumbnails=[thumbnails.get(url) for url in photos],
+        price_per_delivery=p.price_per_delivery,
+        max_deliveries=p.max_deliveries,
+        max_months=p.max_months,
+        type=p.type,
+        size=p.size
+    )
+
+
+async def load_catalog() -> list[dict]:
+    async with async_session() as session:
+        query = select(Product).order_by(Product.id)
+        result = await session.execute(query)
+        return [product_to_out(p).model_dump(mode='json') for p in result.scalars()]
+
+
+catalog = CatalogCache(load_catalog)
+
+
+async def build_product_thumbnails(product_id: int):
+    """Фоновая задача после создания/изменения товара: готовит превью для новых фото."""
+    async with async_session() as session:
+        product = await session.get(Product, product_id)
+        if not product:
+            return
+        photos = product.photos or []
+        old_thumbnails = product.thumbnails or {}
+
+    thumbnails = {url: t for url, t in old_thumbnails.items() if url in photos}
+    for url in photos:
+        if url in thumbnails or not url.startswith(("http://", "https://")):
+            continue
+        try:
+            thumbnails[url] = await images.derivatives(url)
+        except Exception as e:
+            logger.error(f"Не удалось подготовить превью {url} для товара {product_id}: {e!r}")
+
+    if thumbnails == old_thumbnails:
+        return
+    async with async_session() as session:
+        query = update(Product).where(Product.id == product_id).values(thumbnails=thumbnails)
+        await session.execute(query)
+        await session.commit()
+    await catalog.bump()
+
+
+def cart_item_thumbnails(snapshot: CatalogSnapshot, item_id: str, photos: List[str]) -> List[Optional[dict]]:
+    """Превью фото позиции корзины берём из каталога - фото копируются из товара."""
+    product = snapshot.products.get(int(item_id)) if item_id.isdigit() else None
+    if not product:
+        return [None] * len(photos)
+    by_photo = dict(zip(product["photos"], product["thumbnails"]))
+    return [by_photo.get(url) for url in photos]
 
 
 # Public
 @app.get("/products", response_model=List[ProductOut])
-async def get_products():
+async def get_products(
+        product_type: Optional[str] = Query(None, alias="type"),
+        size: Optional[str] = None,
+        price_min: Optional[int] = Query(None, ge=0),
+        price_max: Optional[int] = Query(None, ge=0),
+        max_months: Optional[int] = Query(None, ge=1),  # Товары, на которые можно подписаться хотя бы на столько месяцев
+        sort: Literal["id", "price_asc", "price_desc"] = "id",
+        limit: Optional[int] = Query(None, ge=1, le=200),
+        cursor: Optional[str] = None,
+        if_none_match: Optional[str] = Header(None),
+):
+    filters = (product_type, size, price_min, price_max, max_months, limit, cursor)
+    if all(f is None for f in filters) and sort == "id":
+        # Весь каталог - отдаём из кэша
+        snapshot = await catalog.get()
+        headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+        if etag_matches(if_none_match, snapshot.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+    limit = limit or 50
+    query = select(Product)
+    if product_type is not None:
+        query = query.where(Product.type == product_type)
+    if size is not None:
+        query = query.where(Product.size == size)
+    if price_min is not None:
+        query = query.where(Product.price_per_delivery >= price_min)
+    if price_max is not None:
+        query = query.where(Product.price_per_delivery <= price_max)
+    if max_months is not None:
+        query = query.where(Product.max_months >= max_months)
+
+    # Стабильный порядок: (цена, id) или id - по ним же строится keyset-курсор
+    if sort == "id":
+        if cursor is not None:
+            (last_id,) = decode_cursor(cursor, 1)
+            try:
+                last_id = int(last_id)
+            except (ValueError, TypeError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(Product.id > last_id)
+        query = query.order_by(Product.id)
+    else:
+        key = tuple_(Product.price_per_delivery, Product.id)
+        if cursor is not None:
+            last_price, last_id = decode_cursor(cursor, 2)
+            try:
+                last_key = tuple_(int(last_price), int(last_id))
+            except (ValueError, TypeError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(key > last_key if sort == "price_asc" else key < last_key)
+        if sort == "price_asc":
+            query = query.order_by(Product.price_per_delivery, Product.id)
+        else:
+            query = query.order_by(Product.price_per_delivery.desc(), Product.id.desc())
+
     async with async_session() as session:
-        query = select(Product)
-        result = await session.execute(query)
+        result = await session.execute(query.limit(limit + 1))
         products = result.scalars().all()
-        return [
-            ProductOut(
-                id=p.id,
-                title=p.title,
-                description=p.description,
-                photos=json.loads(p.photos) if p.photos else [],
-                price_per_delivery=p.price_per_delivery,
-                max_deliveries=p.max_deliveries,
-                max_months=p.max_months,
-                type=p.type,
-                size=p.size
-            ) for p in products
-        ]
+
+    headers = {}
+    if len(products) > limit:
+        products = products[:limit]
+        last = products[-1]
+        headers[NEXT_CURSOR_HEADER] = (
+            encode_cursor(last.id) if sort == "id" else encode_cursor(last.price_per_delivery, last.id)
+        )
+    return JSONResponse(
+        content=[product_to_out(p).model_dump(mode='json') for p in products],
+        headers=headers,
+    )
+
+
+# Public
+@app.get("/products/search", response_model=List[ProductOut])
+async def search_products(
+        q: str = Query(..., min_length=2, max_length=100),
+        limit: int = Query(20, ge=1, le=50),
+):
+    ts_query = func.websearch_to_tsquery('russian', q)
+    pattern = '%' + re.sub(r'([\\%_])', r'\\\1', q) + '%'
+    # Полнотекстовое совпадение по названию/описанию или нечёткое по названию (оба - GIN индексы)
+    rank = func.greatest(func.ts_rank(Product.search_vector, ts_query), func.similarity(Product.title, q))
+    query = select(Product).where(or_(
+        Product.search_vector.op('@@')(ts_query),
+        Product.title.op('%')(q),
+        Product.title.ilike(pattern, escape='\\'),
+    )).order_by(rank.desc(), Product.id).limit(limit)
+
+    async with async_session() as session:
+        result = await session.execute(query)
+        return [product_to_out(p) for p in result.scalars()]
 
 
 @app.post("/products", response_model=ProductOut)
-async def create_product(product: ProductIn, _: dict = Security(get_current_admin)):
+async def create_product(
+    product: ProductIn,
+    background_tasks: BackgroundTasks,
+    _: dict = Security(get_current_admin)
+):
     async with async_session() as session:
         db_product = Product(
             title=product.title,
             description=product.description,
-            photos=json.dumps(product.photos),
+            photos=product.photos,
             price_per_delivery=product.price_per_delivery,
             max_deliveries=product.max_deliveries,
             max_months=product.max_months,
@@ -298,21 +530,18 @@ async def create_product(product: ProductIn, _: dict = Security(get_current_admi
         session.add(db_product)
         await session.commit()
         await session.refresh(db_product)
-        return ProductOut(
-            id=db_product.id,
-            title=db_product.title,
-            description=db_product.description,
-            photos=product.photos,
-            price_per_delivery=db_product.price_per_delivery,
-            max_deliveries=db_product.max_deliveries,
-            max_months=db_product.max_months,
-            type=db_product.type,
-            size=db_product.size,
-        )
+        await catalog.bump()
+        background_tasks.add_task(build_product_thumbnails, db_product.id)
+        return product_to_out(db_product)
 
 
 @app.put("/products/{product_id}", response_model=ProductOut)
-async def update_product(product_id: int, product: ProductIn, _: dict = Security(get_current_admin)):
+async def update_product(
+    product_id: int,
+    product: ProductIn,
+    background_tasks: BackgroundTasks,
+    _: dict = Security(get_current_admin)
+):
     async with async_session() as session:
         query = select(Product).where(Product.id == product_id)
         result = await session.execute(query)
@@ -321,7 +550,7 @@ async def update_product(product_id: int, product: ProductIn, _: dict = Security
             raise HTTPException(status_code=404, detail="Product not found")
         db_product.title = product.title
         db_product.description = product.description
-        db_product.photos = json.dumps(product.photos)
+        db_product.photos = product.photos
         db_product.price_per_delivery = product.price_per_delivery
         db_product.max_deliveries = product.max_deliveries
         db_product.max_months = product.max_months
@@ -329,17 +558,9 @@ async def update_product(product_id: int, product: ProductIn, _: dict = Security
         db_product.size = product.size
         await session.commit()
         await session.refresh(db_product)
-        return ProductOut(
-            id=db_product.id,
-            title=db_product.title,
-            description=db_product.description,
-            photos=product.photos,
-            price_per_delivery=db_product.price_per_delivery,
-            max_deliveries=db_product.max_deliveries,
-            max_months=db_product.max_months,
-            type=db_product.type,
-            size=db_product.size,
-        )
+        await catalog.bump()
+        background_tasks.add_task(build_product_thumbnails, db_product.id)
+        return product_to_out(db_product)
 
 
 @app.delete("/products/{product_id}")
@@ -352,6 +573,7 @@ async def delete_product(product_id: int, _: dict = Security(get_current_admin))
             raise HTTPException(status_code=404, detail="Product not found")
         await session.delete(db_product)
         await session.commit()
+        await catalog.bump()
         return {"ok": True}
 
 
@@ -385,6 +607,20 @@ class UserBalanceRequest(BaseModel):
     balance: float
 
 
+class UserBulkFilter(BaseModel):
+    blocked: Optional[bool] = None
+    source_param: Optional[str] = None
+    joined_after: Optional[datetime] = None
+    joined_before: Optional[datetime] = None
+
+
+class UserBulkRequest(BaseModel):
+    action: Literal["block", "unblock", "set_balance", "delete"]
+    user_ids: Optional[List[int]] = None  # Либо список TG ID,
+    filter: Optional[UserBulkFilter] = None  # либо фильтр
+    balance: Optional[float] = None  # Для set_balance
+
+
 class DeliveryOut(BaseModel):
     id: int
     delivery_date: str
@@ -423,26 +659,258 @@ class OrderFullOut(BaseModel):
     comment: Optional[str] = None
 
 
+# Колонки для списка пользователей - без загрузки ORM-сущностей целиком
+USER_LIST_COLUMNS = (
+    User.id, User.user_id, User.avatar, User.phone_number, User.join_time, User.balance,
+    User.daily_launches, User.total_launches, User.blocked, User.first_name, User.last_name, User.source_param,
+)
+
+# Разбор значения ключа сортировки из курсора
+USER_SORT_KEY_PARSERS = {
+    "join_time": datetime.fromisoformat,
+    "balance": Decimal,
+    "total_launches": int,
+}
+
+
+def user_row_to_out(u, pending_launches: dict[int, int]) -> UserOut:
+    """pending_launches - ещё не перенесённые в Postgres запуски (launches.pending_launches())."""
+    pending = pending_launches.get(u.user_id, 0)
+    return UserOut(
+        id=u.id,
+        user_id=u.user_id,
+        avatar=u.avatar,
+        phone_number=u.phone_number,
+        join_time=u.join_time.isoformat() if u.join_time else None,
+        balance=float(u.balance or 0),
+        daily_launches=(u.daily_launches or 0) + pending,
+        total_launches=(u.total_launches or 0) + pending,
+        blocked=u.blocked or False,
+        first_name=u.first_name,
+        last_name=u.last_name,
+        source_param=u.source_param
+    )
+
+
+def users_list_query(
+        blocked: Optional[bool], source_param: Optional[str], sort: str, cursor: Optional[str], limit: int
+) -> tuple[Select, Optional[Any]]:
+    """Запрос GET /users и ключ сортировки (None - по id); limit + 1 строк - чтобы понять, есть ли следующая страница."""
+    query = select(*USER_LIST_COLUMNS)
+    if blocked is not None:
+        query = query.where(User.blocked.is_(True) if blocked else User.blocked.isnot(True))
+    if source_param is not None:
+        query = query.where(User.source_param == source_param)
+
+    # Стабильный порядок: (ключ сортировки, id) или id - по ним же строится keyset-курсор
+    if sort == "id":
+        sort_key = None
+        if cursor is not None:
+            (last_id,) = decode_cursor(cursor, 1)
+            try:
+                last_id = int(last_id)
+            except (ValueError, TypeError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(User.id > last_id)
+        query = query.order_by(User.id)
+    else:
+        name, direction = sort.rsplit("_", 1)
+        sort_key, parse = USER_SORT_KEYS[name], USER_SORT_KEY_PARSERS[name]
+        key = tuple_(sort_key, User.id)
+        if cursor is not None:
+            last_value, last_id = decode_cursor(cursor, 2)
+            try:
+                last_key = tuple_(parse(last_value), int(last_id))
+            except (ValueError, TypeError, ArithmeticError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(key > last_key if direction == "asc" else key < last_key)
+        if direction == "asc":
+            query = query.order_by(sort_key, User.id)
+        else:
+            query = query.order_by(sort_key.desc(), User.id.desc())
+        query = query.add_columns(sort_key.label("sort_key"))
+    return query.limit(limit + 1), sort_key
+
+
 @app.get("/users", response_model=List[UserOut])
-async def get_users(_: dict = Security(get_current_admin)):
+async def get_users(
+        blocked: Optional[bool] = None,
+        source_param: Optional[str] = None,
+        sort: Literal[
+            "id",
+            "join_time_asc", "join_time_desc",
+            "balance_asc", "balance_desc",
+            "total_launches_asc", "total_launches_desc",
+        ] = "id",
+        limit: int = Query(100, ge=1, le=500),
+        cursor: Optional[str] = None,
+        _: dict = Security(get_current_admin)
+):
+    query, sort_key = users_list_query(blocked, source_param, sort, cursor, limit)
     async with async_session() as session:
-        query = select(User)
         result = await session.execute(query)
-        users = result.scalars().all()
-        return [
-            UserOut(
-                id=u.id,
-                user_id=u.user_id,
-                avatar=u.avatar,
-                phone_number=u.phone_number,
-                join_time=u.join_time.isoformat() if u.join_time else None,
-                balance=float(u.balance or 0),
-                daily_launches=u.daily_launches or 0,
-                total_launches=u.total_launches or 0,
-                blocked=getattr(u, "blocked", False),
-                source_param=getattr(u, "source_param", None)
-            ) for u in users
-        ]
+        rows = result.all()
+        total_estimate = await estimate_table_rows(session, User.__tablename__)
+    pending = await launches.pending_launches()
+
+    headers = {TOTAL_COUNT_ESTIMATE_HEADER: str(total_estimate)}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        headers[NEXT_CURSOR_HEADER] = (
+            encode_cursor(last.id) if sort_key is None else encode_cursor(last.sort_key, last.id)
+        )
+    return JSONResponse(
+        content=[user_row_to_out(u, pending).model_dump(mode='json') for u in rows],
+        headers=headers,
+    )
+
+
+MAX_BULK_USER_IDS = 50_000
+BULK_STREAM_CHUNK = 500  # Строк NDJSON в одном куске ответа
+
+
+def user_ids_param(name: str, user_ids: List[int]):
+    """Весь список - один параметр-массив: WHERE user_id = ANY(:ids) вместо IN с тысячами параметров."""
+    return any_(bindparam(name, user_ids, type_=ARRAY(BigInteger)))
+
+
+@app.post("/users/bulk")
+async def bulk_update_users(
+        req: UserBulkRequest,
+        accept: Optional[str] = Header(None),
+        _: dict = Security(get_current_admin)
+):
+    """
+    Блокировка, разблокировка, изменение баланса или удаление многих пользователей одним запросом.
+    С Accept: application/x-ndjson результаты по пользователям отдаются потоком, последней строкой - итог.
+    """
+    if (req.user_ids is None) == (req.filter is None):
+        raise HTTPException(status_code=400, detail="Either user_ids or filter is required")
+    if req.action == "set_balance" and req.balance is None:
+        raise HTTPException(status_code=400, detail="Balance is required")
+
+    if req.user_ids is not None:
+        if len(req.user_ids) > MAX_BULK_USER_IDS:
+            raise HTTPException(status_code=400, detail=f"Too many user_ids (max {MAX_BULK_USER_IDS})")
+        condition = User.user_id == user_ids_param("user_ids", req.user_ids)
+    else:
+        conditions = []
+        if req.filter.blocked is not None:
+            conditions.append(User.blocked.is_(True) if req.filter.blocked else User.blocked.isnot(True))
+        if req.filter.source_param is not None:
+            conditions.append(User.source_param == req.filter.source_param)
+        if req.filter.joined_after is not None:
+            conditions.append(User.join_time >= req.filter.joined_after)
+        if req.filter.joined_before is not None:
+            conditions.append(User.join_time < req.filter.joined_before)
+        if not conditions:
+            raise HTTPException(status_code=400, detail="Empty filter")
+        condition = and_(*conditions)
+
+    returning = (User.user_id, User.blocked, User.balance)
+    async with async_session() as session:
+        if req.action == "delete":
+            # Как и session.delete(user): заказы и транзакции остаются, но отвязываются от пользователя.
+            # Корзина без пользователя не нужна (cart_items.user_id - NOT NULL) и удаляется
+            result = await session.execute(select(User.user_id).where(condition).with_for_update())
+            target_ids = list(result.scalars().all())
+            await session.execute(
+                delete(CartItem).where(CartItem.user_id == user_ids_param("target_ids", target_ids)),
+                execution_options={"synchronize_session": False}
+            )
+            for model in (Transaction, Order):
+                await session.execute(
+                    update(model).where(model.user_id == user_ids_param("target_ids", target_ids)).values(user_id=None),
+                    execution_options={"synchronize_session": False}
+                )
+            query = delete(User).where(User.user_id == user_ids_param("target_ids", target_ids))
+        else:
+            if req.action == "set_balance":
+                values = {"balance": Decimal(str(req.balance))}
+            else:
+                values = {"blocked": req.action == "block"}
+            query = update(User).where(condition).values(**values)
+        result = await session.execute(
+            query.returning(*returning),
+            execution_options={"synchronize_session": False}
+        )
+        rows = result.all()
+        await session.commit()
+
+    if req.action == "delete":
+        await cart_store.drop([r.user_id for r in rows])
+
+    results = [
+        {"user_id": r.user_id, "ok": True, "blocked": bool(r.blocked), "balance": float(r.balance or 0)}
+        for r in rows
+    ]
+    if req.user_ids is not None:
+        found = {r.user_id for r in rows}
+        results.extend(
+            {"user_id": user_id, "ok": False, "detail": "User not found"}
+            for user_id in dict.fromkeys(req.user_ids) if user_id not in found
+        )
+    summary = {"action": req.action, "affected": len(rows)}
+
+    if accept and "application/x-ndjson" in accept:
+        async def lines():
+            for i in range(0, len(results), BULK_STREAM_CHUNK):
+                chunk = results[i:i + BULK_STREAM_CHUNK]
+                yield "".join(json.dumps(r) + "\n" for r in chunk)
+            yield json.dumps(summary) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    return {**summary, "results": results}
+
+
+# Поиск пользователей по номеру телефона или TG ID
+@app.get("/users/search", response_model=List[UserOut])
+async def search_users(
+        q: str = Query(..., min_length=1, max_length=32),
+        limit: int = Query(20, ge=1, le=100),
+        _: dict = Security(get_current_admin)
+):
+    query = user_search_query(q, limit)
+    if query is None:
+        return []
+
+    async with async_session() as session:
+        result = await session.execute(query)
+        rows = result.all()
+
+    pending = await launches.pending_launches()
+    users, seen = [], set()
+    for u in rows:
+        if u.id not in seen:
+            seen.add(u.id)
+            users.append(user_row_to_out(u, pending))
+    return users[:limit]
+
+
+def user_search_query(q: str, limit: int) -> Optional[Select]:
+    """Запрос GET /users/search; None - в запросе нет цифр."""
+    digits = re.sub(r'\D', '', q)
+    if not digits:
+        return None
+    # В phone_digits номера на 8 уже приведены к 7
+    prefix = '7' + digits[1:] if digits.startswith('8') else digits
+
+    # Совпадение по TG ID, затем по началу номера, затем по любой части номера.
+    # Каждая часть ограничена отдельно, чтобы не сортировать все совпадения короткого запроса
+    parts = []
+    if q.strip().isdigit() and len(digits) <= 18:
+        parts.append(select(*USER_LIST_COLUMNS, literal(0).label("rank")).where(User.user_id == int(digits)))
+    parts.append(
+        select(*USER_LIST_COLUMNS, literal(1).label("rank")).where(User.phone_digits.like(prefix + '%')).limit(limit)
+    )
+    if len(digits) >= 3:  # Для более коротких триграммный индекс не работает
+        parts.append(
+            select(*USER_LIST_COLUMNS, literal(2).label("rank"))
+            .where(User.phone_digits.like('%' + digits + '%')).limit(limit)
+        )
+    found = union_all(*parts).subquery()
+    return select(found).order_by(found.c.rank)
 
 
 # Public
@@ -454,6 +922,7 @@ async def get_user(user_id: int):
         user = result.scalar_one_or_none()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
+        pending = (await launches.pending_launches()).get(user.user_id, 0)
         return UserOut(
             id=user.id,
             user_id=user.user_id,
@@ -461,8 +930,8 @@ async def get_user(user_id: int):
             phone_number=user.phone_number,
             join_time=user.join_time.isoformat() if user.join_time else None,
             balance=float(user.balance or 0),
-            daily_launches=user.daily_launches or 0,
-            total_launches=user.total_launches or 0,
+            daily_launches=(user.daily_launches or 0) + pending,
+            total_launches=(user.total_launches or 0) + pending,
             blocked=getattr(user, "blocked", False),
             first_name=getattr(user, "first_name", None),
             last_name=getattr(user, "last_name", None),
@@ -569,70 +1038,72 @@ async def delete_user(user_id: int, _: dict = Security(get_current_admin)):
         return {"ok": True}
 
 
-# Поиск пользователей по номеру телефона или TG ID
-@app.get("/users/search", response_model=List[UserOut])
-async def search_users(q: str, _: dict = Security(get_current_admin)):
-    async with async_session() as session:
-        query = select(User).filter(
-            (User.phone_number.ilike(f"%{q}%")) | (User.user_id == q)
-        )
-        result = await session.execute(query)
-        users = result.scalars().all()
-
-        return [
-            UserOut(
-                id=u.id,
-                user_id=u.user_id,
-                avatar=u.avatar,
-                phone_number=u.phone_number,
-                join_time=u.join_time.isoformat() if u.join_time else None,
-                balance=float(u.balance or 0),
-                daily_launches=u.daily_launches or 0,
-                total_launches=u.total_launches or 0,
-                blocked=getattr(u, "blocked", False),
-                first_name=getattr(u, "first_name", None),
-                last_name=getattr(u, "last_name", None),
-                source_param=getattr(u, "source_param", None)
-            ) for u in users
-        ]
+def user_orders_query(user_id: int, cursor: Optional[str], limit: Optional[int]) -> Select:
+    """Запрос GET /users/{user_id}/orders; limit + 1 строк - чтобы понять, есть ли следующая страница."""
+    # Новые заказы первыми; доставки и позиции всех заказов страницы - отдельными запросами на всю страницу
+    query = (
+        select(Order)
+        .where(Order.user_id == user_id)
+        .options(selectinload(Order.deliveries), selectinload(Order.order_items))
+        .order_by(Order.created_at.desc(), Order.id.desc())
+    )
+    if cursor is not None:
+        last_created_at, last_id = decode_cursor(cursor, 2)
+        try:
+            last_key = tuple_(datetime.fromisoformat(last_created_at), int(last_id))
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(tuple_(Order.created_at, Order.id) < last_key)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query
 
 
 # Public
 @app.get("/users/{user_id}/orders", response_model=List[OrderOut])
-async def get_user_orders(user_id: int):
+async def get_user_orders(
+        user_id: int,
+        limit: Optional[int] = Query(None, ge=1, le=100),  # Без limit - вся история
+        cursor: Optional[str] = None,
+):
+    query = user_orders_query(user_id, cursor, limit)
+
     async with async_session() as session:
-        query = select(Order).filter_by(user_id=user_id)
         query_result = await session.execute(query)
         orders = query_result.scalars().all()
-        result = []
-        for o in orders:
-            query = select(Delivery).filter_by(order_id=o.id)
-            query_result = await session.execute(query)
-            deliveries = query_result.scalars().all()
-            deliveries_out = [
-                DeliveryOut(
-                    id=d.id,
-                    delivery_date=d.delivery_date.isoformat(),
-                    status=d.status
-                ) for d in deliveries
-            ]
-            order_out = OrderOut(
-                id=o.id,
-                user_id=o.user_id,
-                status=o.status,
-                total_amount=float(o.total_amount or 0),
-                created_at=o.created_at.isoformat() if o.created_at else None,
-                updated_at=o.updated_at.isoformat() if o.updated_at else None,
-                items=json.loads(o.items) if o.items else None,
-                order_type=o.order_type,
-                deliveries=deliveries_out,
-                fio=o.fio,
-                phone=o.phone,
-                email=o.email,
-                comment=o.comment,
-            )
-            result.append(order_out)
-        return result
+
+    headers = {}
+    if limit is not None and len(orders) > limit:
+        orders = orders[:limit]
+        last = orders[-1]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(last.created_at, last.id)
+
+    result = []
+    for o in orders:
+        deliveries_out = [
+            DeliveryOut(
+                id=d.id,
+                delivery_date=d.delivery_date.isoformat(),
+                status=d.status
+            ) for d in sorted(o.deliveries, key=lambda d: (d.delivery_date, d.id))
+        ]
+        order_out = OrderOut(
+            id=o.id,
+            user_id=o.user_id,
+            status=o.status,
+            total_amount=float(o.total_amount or 0),
+            created_at=o.created_at.isoformat() if o.created_at else None,
+            updated_at=o.updated_at.isoformat() if o.updated_at else None,
+            items=order_items_out(o),
+            order_type=o.order_type,
+            deliveries=deliveries_out,
+            fio=o.fio,
+            phone=o.phone,
+            email=o.email,
+            comment=o.comment,
+        )
+        result.append(order_out.model_dump(mode='json'))
+    return JSONResponse(content=result, headers=headers)
 
 
 # --------- Корзина ---------
@@ -661,80 +1132,96 @@ class CartItemOut(BaseModel):
     type: CartItemType  # <-- добавить!
     title: str = ""
     photos: List[str] = []
+    thumbnails: List[Optional[Dict[str, Dict[str, str]]]] = []  # Превью для каждого фото из photos
+
+
+class CartBulkItem(BaseModel):
+    id: Optional[int] = None  # Нет id (или он не из этой корзины) - новая позиция
+    item_id: str
+    price: float
+    quantity: int = 1
+    deliveriesPerMonth: int = 1
+    subscriptionMonths: int = 1
+    type: CartItemType = CartItemType.ONE_TIME
+    deliveryDate: str | None = None
+    title: str | None = ""
+    photos: Optional[List[str]] = []
+
+
+class CartBulkRequest(BaseModel):
+    user_id: int
+    items: List[CartBulkItem] = []
+    mode: Literal["replace", "patch"] = "replace"  # replace - items и есть новая корзина, patch - только меняет их
+    remove: List[int] = []  # Для patch: id позиций, которые нужно удалить
+
+
+MAX_CART_ITEMS = 100
+
+
+def cart_item_fields(item: CartItemIn | CartBulkItem) -> dict:
+    """Позиция корзины в том виде, в котором её хранит cart_store (без id и user_id)."""
+    try:
+        delivery_date = datetime.fromisoformat(item.deliveryDate) if item.deliveryDate else None
+    except ValueError:
+        delivery_date = None
+    return {
+        "item_id": item.item_id,
+        "quantity": item.quantity,
+        "price": item.price,
+        "type": item.type.value,
+        "deliveryDate": delivery_date.isoformat() if delivery_date is not None else None,
+        "deliveriesPerMonth": item.deliveriesPerMonth,
+        "subscriptionMonths": item.subscriptionMonths,
+        "title": item.title,
+        "photos": item.photos or [],
+    }
+
+
+def cart_item_out(snapshot: CatalogSnapshot, item: dict) -> CartItemOut:
+    return CartItemOut(**item, thumbnails=cart_item_thumbnails(snapshot, item["item_id"], item["photos"]))
 
 
 @app.post("/cart_items", response_model=CartItemOut)
 async def add_to_cart(item: CartItemIn):
-    async with async_session() as session:
-        try:
-            delivery_date = datetime.fromisoformat(item.deliveryDate) if item.deliveryDate else None
-        except ValueError:
-            delivery_date = None
-
-        cart_item = CartItem(
-            user_id=item.user_id,
-            item_id=item.item_id,
-            quantity=item.quantity,
-            deliveryDate=delivery_date,
-            deliveriesPerMonth=item.deliveriesPerMonth,
-            subscriptionMonths=item.subscriptionMonths,
-            price=item.price,
-            type=item.type,
-            title=item.title,
-            photos=json.dumps(item.photos),
-        )
-        session.add(cart_item)
-        await session.commit()
-        await session.refresh(cart_item)
-        return CartItemOut(
-            id=cart_item.id,
-            user_id=cart_item.user_id,
-            item_id=cart_item.item_id,
-            quantity=cart_item.quantity,
-            deliveryDate=cart_item.deliveryDate.isoformat() if cart_item.deliveryDate is not None else None,
-            deliveriesPerMonth=cart_item.deliveriesPerMonth,
-            subscriptionMonths=cart_item.subscriptionMonths,
-            price=cart_item.price,
-            type=cart_item.type,
-            title=cart_item.title,
-            photos=json.loads(cart_item.photos)
-        )
+    cart_item = await cart_store.add_item(item.user_id, cart_item_fields(item))
+    if cart_item is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    snapshot = await catalog.get()
+    return cart_item_out(snapshot, cart_item)
 
 
 @app.get("/cart_items", response_model=List[CartItemOut])
 async def get_cart(user_id: int):
-    async with async_session() as session:
-        query = select(CartItem).where(CartItem.user_id == user_id)
-        result = await session.execute(query)
-        items: list[CartItem] = result.scalars().all()
-        return [
-            CartItemOut(
-                id=i.id,
-                user_id=i.user_id,
-                item_id=i.item_id,
-                quantity=i.quantity,
-                deliveryDate=i.deliveryDate.isoformat() if i.deliveryDate is not None else None,
-                deliveriesPerMonth=i.deliveriesPerMonth,
-                subscriptionMonths=i.subscriptionMonths,
-                price=i.price,
-                type=i.type,
-                title=i.title,
-                photos=json.loads(i.photos)
-            ) for i in items
-        ]
+    items = await cart_store.get_items(user_id)
+    snapshot = await catalog.get()
+    return [cart_item_out(snapshot, i) for i in items]
+
+
+@app.put("/cart_items/bulk", response_model=List[CartItemOut])
+async def bulk_update_cart(req: CartBulkRequest):
+    """
+    Синхронизация всей корзины одним запросом: сравнивает присланные позиции с сохранёнными
+    и применяет разницу одной транзакцией Redis. В cart_items изменения попадут одной пачкой при записи корзин.
+    """
+    if len(req.items) > MAX_CART_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many cart items (max {MAX_CART_ITEMS})")
+    items = await cart_store.apply(
+        req.user_id,
+        [(item.id, cart_item_fields(item)) for item in req.items],
+        remove=req.remove,
+        replace=req.mode == "replace",
+    )
+    if items is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    snapshot = await catalog.get()
+    return [cart_item_out(snapshot, i) for i in items]
 
 
 @app.delete("/cart_items/{item_id}")
 async def remove_from_cart(item_id: int):
-    async with async_session() as session:
-        query = select(CartItem).where(CartItem.id == item_id)
-        result = await session.execute(query)
-        item = result.scalar_one_or_none()
-        if not item:
-            raise HTTPException(status_code=404, detail="Cart item not found")
-        await session.delete(item)
-        await session.commit()
-        return {"ok": True}
+    if not await cart_store.remove_item(item_id):
+        raise HTTPException(status_code=404, detail="Cart item not found")
+    return {"ok": True}
 
 
 # ----------- Заказы из корзины (frontend) -----------
@@ -743,15 +1230,16 @@ class CartOrderItem(BaseModel):
     deliveries_per_month: int | None = None
     subscription_months: int | None = None
     deliveryDate: str | None = None
-    price: int
+    price: int  # Не доверяем: create_order пересчитывает по каталогу
     title: str
 
 
 class OrderIn(BaseModel):
     user_id: int
     items: List[CartOrderItem]
-    total_amount: float
+    total_amount: float  # Сумма, которую видел покупатель; должна совпасть с пересчитанной
     order_type: str
+    extras: List[Literal["vaza", "sekator"]] = []
     fio: Optional[str] = None
     phone: Optional[str] = None
     email: Optional[str] = None
@@ -776,28 +1264,53 @@ class TransactionOut(BaseModel):
     created_at: str
 
 
+# Разрешённые переходы статусов заказа. pending_payment -> created/canceled обычно делает вебхук оплаты,
+# из canceled вернуть заказ нельзя - деньги по нему уже не придут
+ORDER_STATUS_TRANSITIONS: dict[str, set[str]] = {
+    "pending_payment": {"created", "canceled"},
+    "created": {"assembling", "delivered", "canceled"},
+    "assembling": {"created", "delivered", "canceled"},
+    "delivered": {"created", "assembling"},
+    "canceled": set(),
+}
+
+
 class OrderStatusUpdate(BaseModel):
     status: str
+    expected_status: Optional[str] = None  # Статус, который видел админ; если заказ успели изменить - 409
+
+
+async def set_order_status(session, order_id: int, expected: str, status: str) -> bool:
+    """
+    Условный UPDATE вместо чтения и записи объекта: статус меняется, только если заказ всё ещё в expected.
+    False - заказ успели перевести в другой статус (админ или вебхук), ничего не изменено.
+    """
+    result = await session.execute(
+        update(Order).where(Order.id == order_id, Order.status == expected).values(status=status).returning(Order.id)
+    )
+    return result.first() is not None
 
 
 # Public
 @app.post("/orders", response_model=OrderOut)
 async def create_order(order: OrderIn):
+    # Цены - из снимка каталога в памяти, без запроса в Postgres на каждую позицию
+    snapshot = await catalog.get()
+    try:
+        items_as_dicts, total = price_order(snapshot.products, [item.model_dump() for item in order.items], order.extras)
+    except PricingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if Decimal(str(order.total_amount)) != total:
+        logger.info(f"Сумма заказа пользователя {order.user_id} не совпала: {order.total_amount} вместо {total}")
+        raise HTTPException(status_code=409, detail=f"Order total mismatch: expected {total}")
+
     async with async_session() as session:
-        # Гарантируем: каждый item — dict
-        items_as_dicts = []
-        for item in order.items:
-            if hasattr(item, "dict"):
-                items_as_dicts.append(item.model_dump())
-            else:
-                items_as_dicts.append(item)
         db_order = Order(
             user_id=order.user_id,
             status="pending_payment",
-            total_amount=Decimal(order.total_amount),
+            total_amount=Decimal(total),
             created_at=datetime.now(),
             updated_at=datetime.now(),
-            items=json.dumps(items_as_dicts),
             order_type=order.order_type,
             fio=order.fio,
             phone=order.phone,
@@ -805,69 +1318,78 @@ async def create_order(order: OrderIn):
             comment=order.comment,
         )
         session.add(db_order)
-        await session.commit()
-        await session.refresh(db_order)
-
-        # --- Создаём Delivery объекты для подписки ---
-        deliveries = []
-        if order.order_type == "subscription" and order.items:
-            item = order.items[0]
-            # Универсально: получаем dict
-            item_d = item.model_dump() if hasattr(item, "dict") else item
-            dpm = item_d.get("deliveries_per_month") or item_d.get("deliveriesPerMonth", 1)
-            sm = item_d.get("subscription_months") or item_d.get("subscriptionMonths", 1)
-            dpm = int(dpm) if dpm else 1
-            sm = int(sm) if sm else 1
-            total = dpm * sm
-            for i in range(total):
-                delivery_date = db_order.created_at + timedelta(days=30 * i // dpm)
-                delivery = Delivery(
-                    order_id=db_order.id,
-                    delivery_date=delivery_date,
-                    status="scheduled"
-                )
-                session.add(delivery)
-                deliveries.append(delivery)
-            await session.commit()
+        await session.flush()
+
+        # Все позиции - одним INSERT
+        item_rows = order_item_rows(db_order.id, items_as_dicts)
+        if item_rows:
+            await session.execute(insert(OrderItem), item_rows)
+
+        # --- Расписание доставок для подписки - одним INSERT ... RETURNING ---
+        delivery_rows = []
+        if order.order_type == "subscription":
+            item = items_as_dicts[0]
+            dpm = int(item["deliveries_per_month"]) if item["deliveries_per_month"] else 1
+            sm = int(item["subscription_months"]) if item["subscription_months"] else 1
+            delivery_rows = [
+                {
+                    "order_id": db_order.id,
+                    "delivery_date": db_order.created_at + timedelta(days=30 * i // dpm),
+                    "status": "scheduled",
+                } for i in range(dpm * sm)
+            ]
+        deliveries_out = []
+        if delivery_rows:
+            query = insert(Delivery).returning(
+                Delivery.id, Delivery.delivery_date, Delivery.status, sort_by_parameter_order=True
+            )
+            result = await session.execute(query, delivery_rows)
             deliveries_out = [
                 DeliveryOut(
                     id=d.id,
                     delivery_date=d.delivery_date.isoformat(),
                     status=d.status
-                ) for d in deliveries
+                ) for d in result.all()
             ]
-        else:
-            deliveries_out = []
 
-        total_amount = float(db_order.total_amount)
-        notification_data = {
-            "user_id": order.user_id,
-            "text": f"Создан новый заказ #{db_order.id} на сумму {total_amount}₽"
-        }
-        redis_client = Redis(host=RedisKeys.HOST, port=RedisKeys.PORT, db=RedisKeys.DATABASE, decode_responses=True)
-        await redis_client.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps(notification_data))
+        # Заказ, позиции и доставки сохраняются вместе
+        await session.commit()
 
-        return OrderOut(
-            id=db_order.id,
-            user_id=db_order.user_id,
-            status=db_order.status,
-            total_amount=total_amount,
-            created_at=db_order.created_at.isoformat(),
-            updated_at=db_order.updated_at.isoformat(),
-            items=items_as_dicts,
-            order_type=db_order.order_type,
-            deliveries=deliveries_out,
-            fio=db_order.fio,
-            phone=db_order.phone,
-            email=db_order.email,
-            comment=db_order.comment,
-        )
+    total_amount = float(db_order.total_amount)
+    notification_data = {
+        "user_id": order.user_id,
+        "text": f"Создан новый заказ #{db_order.id} на сумму {total_amount}₽"
+    }
+    try:
+        await redis.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps(notification_data))
+    except RedisError as e:
+        logger.error(f"Не удалось отправить уведомление о заказе #{db_order.id}: {e!r}")
+
+    return OrderOut(
+        id=db_order.id,
+        user_id=db_order.user_id,
+        status=db_order.status,
+        total_amount=total_amount,
+        created_at=db_order.created_at.isoformat(),
+        updated_at=db_order.updated_at.isoformat(),
+        items=items_as_dicts,
+        order_type=db_order.order_type,
+        deliveries=deliveries_out,
+        fio=db_order.fio,
+        phone=db_order.phone,
+        email=db_order.email,
+        comment=db_order.comment,
+    )
 
 
 @app.get("/orders", response_model=List[OrderFullOut])
 async def get_all_orders(_: dict = Security(get_current_admin)):
     async with async_session() as session:
-        query = select(Order).filter(Order.status.notin_(["pending_payment", "canceled"]))
+        query = (
+            select(Order)
+            .filter(Order.status.notin_(["pending_payment", "canceled"]))
+            .options(selectinload(Order.order_items))
+        )
         query_result = await session.execute(query)
         orders = query_result.scalars().all()
         user_ids = {o.user_id for o in orders}
@@ -886,7 +1408,7 @@ async def get_all_orders(_: dict = Security(get_current_admin)):
                 total_amount=float(o.total_amount or 0),
                 created_at=o.created_at.isoformat() if o.created_at else None,
                 updated_at=o.updated_at.isoformat() if o.updated_at else None,
-                items=json.loads(o.items) if getattr(o, "items", None) else None,
+                items=order_items_out(o),
                 order_type=o.order_type,
                 fio=o.fio,
                 phone=o.phone,
@@ -899,16 +1421,24 @@ async def get_all_orders(_: dict = Security(get_current_admin)):
 @app.patch("/orders/{order_id}/status", response_model=OrderOut)
 async def update_order_status(order_id: int, req: OrderStatusUpdate, _: dict = Security(get_current_admin)):
     async with async_session() as session:
-        query = select(Order).where(Order.id == order_id)
-        result = await session.execute(query)
-        order: Order | None = result.scalar_one_or_none()
-
-        if not order:
+        result = await session.execute(select(Order.status).where(Order.id == order_id))
+        row = result.first()
+        if row is None:
             raise HTTPException(status_code=404, detail="Order not found")
+        current = row.status
+        if req.expected_status is not None and req.expected_status != current:
+            raise HTTPException(status_code=409, detail=f"Order status has changed to {current}")
+
+        if req.status != current:
+            if req.status not in ORDER_STATUS_TRANSITIONS.get(current, ()):
+                raise HTTPException(status_code=409, detail=f"Cannot change order status from {current} to {req.status}")
+            if not await set_order_status(session, order_id, current, req.status):
+                raise HTTPException(status_code=409, detail="Order status has changed")
 
-        order.status = req.status
+        query = select(Order).where(Order.id == order_id).options(selectinload(Order.order_items))
+        result = await session.execute(query)
+        order: Order = result.scalar_one()
         await session.commit()
-        await session.refresh(order)
 
         return OrderOut(
             id=order.id,
@@ -917,7 +1447,7 @@ async def update_order_status(order_id: int, req: OrderStatusUpdate, _: dict = S
             total_amount=float(order.total_amount),
             created_at=order.created_at.isoformat() if order.created_at else None,
             updated_at=order.updated_at.isoformat() if order.updated_at else None,
-            items=json.loads(order.items) if order.items else None,
+            items=order_items_out(order),
             fio=order.fio,
             phone=order.phone,
             email=order.email,
@@ -925,20 +1455,102 @@ async def update_order_status(order_id: int, req: OrderStatusUpdate, _: dict = S
         )
 
 
+def order_deliveries_query(order_id: int) -> Select:
+    return select(Delivery).where(Delivery.order_id == order_id)
+
+
 @app.get("/orders/{order_id}/deliveries", response_model=List[DeliveryOut])
 async def get_order_deliveries(order_id: int, _: dict = Security(get_current_admin)):
     async with async_session() as session:
-        query = select(Delivery).where(Delivery.order_id == order_id)
+        query = order_deliveries_query(order_id)
         result = await session.execute(query)
         deliveries = result.scalars().all()
         return [DeliveryOut(id=d.id, delivery_date=d.delivery_date.isoformat(), status=d.status) for d in deliveries]
 
 
+MAX_CALENDAR_DAYS = 92
+
+
+class CalendarDeliveryOut(DeliveryOut):
+    order_id: int
+    user_id: Optional[int]
+    order_type: Optional[str]
+    fio: Optional[str] = None
+    phone: Optional[str] = None
+    comment: Optional[str] = None
+
+
+class CalendarDayOut(BaseModel):
+    date: str
+    counts: Dict[str, int]  # Число доставок по статусам
+    deliveries: List[CalendarDeliveryOut]
+
+
+def delivery_calendar_query(date_from: date, date_to: date) -> Select:
+    return (
+        select(
+            Delivery.id, Delivery.delivery_date, Delivery.status, Delivery.order_id,
+            Order.user_id, Order.order_type, Order.fio, Order.phone, Order.comment,
+        )
+        .join(Order, Order.id == Delivery.order_id)
+        .where(
+            Delivery.delivery_date >= datetime.combine(date_from, datetime.min.time()),
+            Delivery.delivery_date < datetime.combine(date_to + timedelta(days=1), datetime.min.time()),
+            Order.status.notin_(["pending_payment", "canceled"]),
+        )
+        .order_by(Delivery.delivery_date, Delivery.id)
+    )
+
+
+@app.get("/deliveries/calendar", response_model=List[CalendarDayOut])
+async def get_delivery_calendar(
+        date_from: date = Query(..., alias="from"),
+        date_to: date = Query(..., alias="to"),  # Включительно
+        _: dict = Security(get_current_admin)
+):
+    """Доставки оплаченных заказов по дням за период - одним запросом по индексу (delivery_date, status)."""
+    if date_to < date_from:
+        raise HTTPException(status_code=400, detail="'to' must not be earlier than 'from'")
+    days = (date_to - date_from).days + 1
+    if days > MAX_CALENDAR_DAYS:
+        raise HTTPException(status_code=400, detail=f"Period is too long (max {MAX_CALENDAR_DAYS} days)")
+
+    query = delivery_calendar_query(date_from, date_to)
+    async with async_session() as session:
+        result = await session.execute(query)
+        rows = result.all()
+
+    calendar = {
+        (date_from + timedelta(days=i)): CalendarDayOut(
+            date=(date_from + timedelta(days=i)).isoformat(), counts={}, deliveries=[]
+        ) for i in range(days)
+    }
+    for r in rows:
+        day = calendar[r.delivery_date.date()]
+        day.counts[r.status] = day.counts.get(r.status, 0) + 1
+        day.deliveries.append(CalendarDeliveryOut(
+            id=r.id,
+            delivery_date=r.delivery_date.isoformat(),
+            status=r.status,
+            order_id=r.order_id,
+            user_id=r.user_id,
+            order_type=r.order_type,
+            fio=r.fio,
+            phone=r.phone,
+            comment=r.comment,
+        ))
+    return list(calendar.values())
+
+
+def user_transactions_query(user_id: int) -> Select:
+    return select(Transaction).where(Transaction.user_id == user_id)
+
+
 # Public
 @app.get("/api/user/{user_id}/transactions", response_model=List[TransactionOut])
 async def get_user_transactions(user_id: int):
     async with async_session() as session:
-        query = select(Transaction).where(Transaction.user_id == user_id)
+        query = user_transactions_query(user_id)
         result = await session.execute(query)
         transactions = result.scalars().all()
         return [
@@ -958,8 +1570,17 @@ class UpdateDeliveryDateRequest(BaseModel):
     delivery_date: str  # ISO формат
 
 
+# Отменённую или доставленную по ошибке доставку админ может вернуть в план
+DELIVERY_STATUS_TRANSITIONS: dict[str, set[str]] = {
+    "scheduled": {"delivered", "canceled"},
+    "delivered": {"scheduled"},
+    "canceled": {"scheduled"},
+}
+
+
 class DeliveryStatusUpdate(BaseModel):
     status: str
+    expected_status: Optional[str] = None
 
 
 @app.patch("/deliveries/{delivery_id}/date", response_model=DeliveryOut)
@@ -970,7 +1591,11 @@ async def update_delivery_date(delivery_id: int, req: UpdateDeliveryDateRequest,
         delivery = result.scalar_one_or_none()
         if not delivery:
             raise HTTPException(status_code=404, detail="Delivery not found")
-        delivery.delivery_date = datetime.fromisoformat(req.date)
+        new_date = datetime.fromisoformat(req.delivery_date)
+        if new_date != delivery.delivery_date:
+            # Напоминание о прежней дате не считается напоминанием о новой
+            delivery.reminder_sent_at = None
+        delivery.delivery_date = new_date
         await session.commit()
         await session.refresh(delivery)
         return DeliveryOut(
@@ -983,14 +1608,30 @@ async def update_delivery_date(delivery_id: int, req: UpdateDeliveryDateRequest,
 @app.patch("/deliveries/{delivery_id}/status", response_model=DeliveryOut)
 async def update_delivery_status(delivery_id: int, req: DeliveryStatusUpdate, _: dict = Security(get_current_admin)):
     async with async_session() as session:
-        query = select(Delivery).where(Delivery.id == delivery_id)
-        result = await session.execute(query)
-        delivery = result.scalar_one_or_none()
-        if not delivery:
+        result = await session.execute(select(Delivery.status).where(Delivery.id == delivery_id))
+        row = result.first()
+        if row is None:
             raise HTTPException(status_code=404, detail="Delivery not found")
-        delivery.status = req.status
+        current = row.status
+        if req.expected_status is not None and req.expected_status != current:
+            raise HTTPException(status_code=409, detail=f"Delivery status has changed to {current}")
+        if req.status != current and req.status not in DELIVERY_STATUS_TRANSITIONS.get(current, ()):
+            raise HTTPException(status_code=409, detail=f"Cannot change delivery status from {current} to {req.status}")
+
+        values = {"status": req.status}
+        if req.status == "scheduled" and current != "scheduled":
+            values["reminder_sent_at"] = None  # Возвращённой в план доставке снова нужно напоминание
+        query = (
+            update(Delivery)
+            .where(Delivery.id == delivery_id, Delivery.status == current)
+            .values(**values)
+            .returning(Delivery.id, Delivery.delivery_date, Delivery.status)
+        )
+        result = await session.execute(query)
+        delivery = result.first()
+        if delivery is None:
+            raise HTTPException(status_code=409, detail="Delivery status has changed")
         await session.commit()
-        await session.refresh(delivery)
         return DeliveryOut(
             id=delivery.id,
             delivery_date=delivery.delivery_date.isoformat(),
@@ -1020,9 +1661,65 @@ def format_phone(phone: str) -> str:
     return None
 
 
+async def create_gateway_payment(payload: dict, idempotence_key: str) -> CreatedPayment:
+    try:
+        return await payment_gateway.create_payment(payload, idempotence_key=idempotence_key)
+    except PaymentGatewayUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except PaymentGatewayError as e:
+        logger.info(f"Ошибка создания платежа: {e} (HTTP {e.status})")
+        status_code = 400 if e.status and 400 <= e.status < 500 else 502
+        raise HTTPException(status_code=status_code, detail=f"Ошибка создания платежа: {e}")
+
+
+# Без заголовка Idempotency-Key повтором считается такое же пополнение, пришедшее не позже
+# чем через столько секунд после первого
+DEPOSIT_DEDUP_TTL = 60  # Секунд
+
+
+async def create_payment_once(scope: str, key: str, data: BaseModel, handler, ttl: int = idempotency.RESULT_TTL) -> dict:
+    """Двойное нажатие "Оплатить" и повторы WebView получают ответ первого запроса, а не новый платёж."""
+    try:
+        return await idempotency.run_once(scope, key, data.model_dump(), handler, ttl)
+    except idempotency.RequestInProgress:
+        raise HTTPException(status_code=409, detail="Payment request is already in progress")
+    except idempotency.KeyReused:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with different parameters")
+
+
 # Public
 @app.post("/api/pay", response_model=dict)
-async def create_payment(data: CreatePaymentRequest):
+async def create_payment(
+        data: CreatePaymentRequest,
+        idempotency_key: Optional[str] = Header(None, max_length=idempotency.MAX_KEY_LENGTH)
+):
+    if idempotency_key:
+        key = f"{data.user_id}:{idempotency_key}"
+    else:
+        key = f"order:{data.order_id}:{Decimal(str(data.amount))}"
+    return await create_payment_once("pay", key, data, lambda idempotence_key: pay_order(data, idempotence_key))
+
+
+async def save_payment_transaction(session: AsyncSession, values: dict) -> int:
+    """
+    Записывает транзакцию платежа и возвращает её id. Повтор запроса с тем же Idempotence-Key
+    получает от ЮKassa тот же платёж - тогда возвращается уже записанная транзакция.
+    """
+    query = (
+        insert(Transaction)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=[Transaction.payment_id])
+        .returning(Transaction.id)
+    )
+    transaction_id = await session.scalar(query)
+    if transaction_id is None:
+        transaction_id = await session.scalar(
+            select(Transaction.id).where(Transaction.payment_id == values["payment_id"])
+        )
+    return transaction_id
+
+
+async def pay_order(data: CreatePaymentRequest, idempotence_key: str) -> dict:
     async with async_session() as session:
         query = select(Order).where(Order.id == data.order_id)
         result = await session.execute(query)
@@ -1032,6 +1729,9 @@ async def create_payment(data: CreatePaymentRequest):
             raise HTTPException(status_code=404, detail="Order not found")
         if order.status != "pending_payment":
             raise HTTPException(status_code=409, detail="Заказ уже оплачен или отменён")
+        # Сумма заказа посчитана сервером в create_order - платёж на другую сумму не создаём
+        if Decimal(str(data.amount)) != order.total_amount:
+            raise HTTPException(status_code=409, detail=f"Payment amount mismatch: expected {order.total_amount}")
 
         # Собираем customer
         customer = {}
@@ -1070,24 +1770,23 @@ async def create_payment(data: CreatePaymentRequest):
             ]
         }
 
-        try:
-            payment = Payment.create({
-                "amount": {
-                    "value": str(round(data.amount, 2)),
-                    "currency": "RUB"
-                },
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": data.return_url
-                },
-                "capture": True,
-                "description": data.description,
-                "receipt": receipt
-            })
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Ошибка создания платежа: {str(e)}")
+    # Соединение с Postgres не держим, пока ждём ЮKassa
+    payment = await create_gateway_payment({
+        "amount": {
+            "value": str(round(data.amount, 2)),
+            "currency": "RUB"
+        },
+        "confirmation": {
+            "type": "redirect",
+            "return_url": data.return_url
+        },
+        "capture": True,
+        "description": data.description,
+        "receipt": receipt
+    }, idempotence_key)
 
-        db_tran = Transaction(
+    async with async_session() as session:
+        transaction_id = await save_payment_transaction(session, dict(
             user_id=data.user_id,
             order_id=data.order_id,
             amount=data.amount,
@@ -1096,16 +1795,14 @@ async def create_payment(data: CreatePaymentRequest):
             transaction_type="yookassa",
             timestamp=datetime.now(),
             description=data.description
-        )
-        session.add(db_tran)
+        ))
         await session.commit()
-        await session.refresh(db_tran)
-        return {
-            "confirmation_url": payment.confirmation.confirmation_url,
-            "payment_id": payment.id,
-            "status": payment.status,
-            "transaction_id": db_tran.id
-        }
+    return {
+        "confirmation_url": payment.confirmation_url,
+        "payment_id": payment.id,
+        "status": payment.status,
+        "transaction_id": transaction_id
+    }
 
 
 class DepositPayRequest(BaseModel):
@@ -1117,7 +1814,22 @@ class DepositPayRequest(BaseModel):
 
 # Public
 @app.post("/api/deposit_pay")
-async def deposit_pay(data: DepositPayRequest):
+async def deposit_pay(
+        data: DepositPayRequest,
+        idempotency_key: Optional[str] = Header(None, max_length=idempotency.MAX_KEY_LENGTH)
+):
+    handler = lambda idempotence_key: pay_deposit(data, idempotence_key)
+    if idempotency_key:
+        return await create_payment_once("deposit", f"{data.user_id}:{idempotency_key}", data, handler)
+    # Ключ без привязки к интервалам времени: повтор через секунду после первого запроса не разойдётся
+    # с ним по соседним интервалам. Idempotence-Key для ЮKassa при этом случайный - иначе такое же
+    # пополнение после DEPOSIT_DEDUP_TTL получило бы от ЮKassa старый платёж (она помнит ключ сутки)
+    key = f"{data.user_id}:{Decimal(str(data.amount))}"
+    handler = lambda _: pay_deposit(data, uuid4().hex)
+    return await create_payment_once("deposit", key, data, handler, ttl=DEPOSIT_DEDUP_TTL)
+
+
+async def pay_deposit(data: DepositPayRequest, idempotence_key: str) -> dict:
     async with async_session() as session:
         query = select(User).where(User.user_id == data.user_id)
         result = await session.execute(query)
@@ -1126,20 +1838,21 @@ async def deposit_pay(data: DepositPayRequest):
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        payment = Payment.create({
-            "amount": {
-                "value": str(round(data.amount, 2)),
-                "currency": "RUB"
-            },
-            "confirmation": {
-                "type": "redirect",
-                "return_url": data.return_url
-            },
-            "capture": True,
-            "description": data.description
-        })
-
-        db_tran = Transaction(
+    payment = await create_gateway_payment({
+        "amount": {
+            "value": str(round(data.amount, 2)),
+            "currency": "RUB"
+        },
+        "confirmation": {
+            "type": "redirect",
+            "return_url": data.return_url
+        },
+        "capture": True,
+        "description": data.description
+    }, idempotence_key)
+
+    async with async_session() as session:
+        transaction_id = await save_payment_transaction(session, dict(
             user_id=data.user_id,
             order_id=None,
             amount=data.amount,
@@ -1148,174 +1861,212 @@ async def deposit_pay(data: DepositPayRequest):
             transaction_type="yookassa",
             timestamp=datetime.now(),
             description=data.description
-        )
-
-        session.add(db_tran)
+        ))
         await session.commit()
-        await session.refresh(db_tran)
 
-        return {
-            "confirmation_url": payment.confirmation.confirmation_url,
-            "payment_id": payment.id,
-            "status": payment.status,
-            "transaction_id": db_tran.id
-        }
+    return {
+        "confirmation_url": payment.confirmation_url,
+        "payment_id": payment.id,
+        "status": payment.status,
+        "transaction_id": transaction_id
+    }
 
 
 # Public
 @app.post("/api/deposit_pay_web")
-async def deposit_pay_web(data: DepositPayRequest):
-    return await deposit_pay(data)
+async def deposit_pay_web(
+        data: DepositPayRequest,
+        idempotency_key: Optional[str] = Header(None, max_length=idempotency.MAX_KEY_LENGTH)
+):
+    return await deposit_pay(data, idempotency_key)
+
+
+# Вебхуки по транзакции в этих статусах больше ничего не меняют
+TRANSACTION_FINAL_STATUSES = ("succeeded", "canceled")
+
+
+YOOKASSA_NETWORKS = [ip_network(network) for network in (
+    "185.71.76.0/27",
+    "185.71.77.0/27",
+    "77.75.153.0/25",
+    "77.75.156.11",
+    "77.75.156.35",
+    "77.75.154.128/25",
+    "2a02:5180::/32",
+)]
+
+
+def is_yookassa_ip(host: str) -> bool:
+    try:
+        address = ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in YOOKASSA_NETWORKS)
 
 
 # Public
 @app.post("/api/yookassa/webhook")
 async def yookassa_webhook(request: Request):
+    """
+    Только проверяет запрос и ставит событие в очередь payment_events: ЮKassa получает ответ сразу,
+    а не после всех запросов к Postgres и Redis, и не повторяет вебхуки из-за медленных ответов.
+    """
+    # Проверка IP ЮKassa
+    client_ip = request.client.host
+    if not is_yookassa_ip(client_ip):
+        logger.info(f"[Webhook] Неверный IP: {client_ip}")
+        raise HTTPException(status_code=403, detail="Invalid source IP")
+
     try:
         payload = await request.json()
-        logger.info(f"[Webhook] Получен запрос на /api/yookassa/webhook:")
-        logger.info(f"[Webhook] IP клиента: {request.client.host}")
-        logger.info(f"[Webhook] Заголовки: {dict(request.headers)}")
-        logger.info(f"[Webhook] Payload: {json.dumps(payload, ensure_ascii=False)}")
-
-        # Проверка структуры payload
-        if not isinstance(payload, dict) or "object" not in payload or "event" not in payload:
-            logger.info("[Webhook] Неверная структура payload")
-            raise HTTPException(status_code=400, detail="Invalid payload structure")
-
-        event = payload.get("event")
-        payment_obj = payload.get("object", {})
-        payment_id = payment_obj.get("id")
-        status = payment_obj.get("status")
-
-        logger.info(f"[Webhook] Получено событие: {event}, статус платежа: {status}, payment_id: {payment_id}")
-
-        if not payment_id or not status:
-            logger.info("[Webhook] Отсутствует payment_id или status")
-            raise HTTPException(status_code=400, detail="Missing payment_id or status")
-
-        # Проверка IP ЮKassa (обновлённый список)
-        client_ip = request.client.host
-        yookassa_ips = [
-            "185.71.76.0/27",
-            "185.71.77.0/27",
-            "77.75.153.0/25",
-            "77.75.156.11",
-            "77.75.156.35",
-            "77.75.154.128/25",
-            "2a02:5180::/32"
-        ]
-        ip_allowed = False
-        for ip_range in yookassa_ips:
-            base_ip = ip_range.split("/")[0]
-            if client_ip.startswith(base_ip.rsplit(".", 1)[0]):
-                ip_allowed = True
-                break
-        if not ip_allowed:
-            logger.info(f"[Webhook] Неверный IP: {client_ip}")
-            raise HTTPException(status_code=403, detail="Invalid source IP")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
 
-        async with async_session() as session:
-            query = select(Transaction).where(Transaction.payment_id == payment_id)
-            query_result = await session.execute(query)
-            transaction = query_result.scalar_one_or_none()
-
-            if not transaction:
-                logger.info(f"[Webhook] Транзакция с payment_id {payment_id} не найдена")
-                raise HTTPException(status_code=404, detail="Transaction not found")
-            logger.info(f"[Webhook] Найдена транзакция: id={transaction.id}, order_id={transaction.order_id}, user_id={transaction.user_id}, status={transaction.status}")
-
-            # Обновление статуса транзакции
-            old_tran_status = transaction.status
-            transaction.status = status
-            transaction.updated_at = datetime.now()
-            logger.info(f"[Webhook] Статус транзакции обновлён: {old_tran_status} -> {transaction.status}")
-
-            # Работа с заказом
-            if transaction.order_id:
-                query = select(Order).filter_by(id=transaction.order_id)
-                query_result = await session.execute(query)
-                order = query_result.scalar_one_or_none()
-                if not order:
-                    logger.info(f"[Webhook] Заказ с id {transaction.order_id} не найден")
-                else:
-                    logger.info(f"[Webhook] Заказ найден: id={order.id}, user_id={order.user_id}, status={order.status}, total_amount={order.total_amount}")
+    # Проверка структуры payload
+    if not isinstance(payload, dict) or not isinstance(payload.get("object"), dict) or "event" not in payload:
+        logger.info("[Webhook] Неверная структура payload")
+        raise HTTPException(status_code=400, detail="Invalid payload structure")
+
+    payment_id = payload["object"].get("id")
+    status = payload["object"].get("status")
+    if not payment_id or not status:
+        logger.info("[Webhook] Отсутствует payment_id или status")
+        raise HTTPException(status_code=400, detail="Missing payment_id or status")
+
+    try:
+        await payment_events.publish(str(payment_id), payload)
+    except RedisError as e:
+        # ЮKassa повторит вебхук
+        logger.error(f"[Webhook] Не удалось поставить вебхук {payment_id} в очередь: {e!r}")
+        raise HTTPException(status_code=503, detail="Webhook queue is unavailable")
+
+    logger.info(f"[Webhook] Принято событие {payload['event']}, статус платежа: {status}, payment_id: {payment_id}")
+    return {"ok": True}
 
-                    # Логика по статусу платежа
-                    if status == "succeeded":
-                        old_order_status = order.status
-                        order.status = "created"
-                        order.updated_at = datetime.now()
 
+def transaction_by_payment_query(payment_id: str) -> Select:
+    return select(Transaction).where(Transaction.payment_id == payment_id)
+
+
+async def apply_payment_event(payload: dict) -> None:
+    """Применяет вебхук ЮKassa из очереди. Исключение - событие будет повторено воркером payment_events."""
+    payment_obj = payload["object"]
+    payment_id = payment_obj["id"]
+    status = payment_obj["status"]
+
+    notifications = []
+    async with async_session() as session:
+        query = transaction_by_payment_query(payment_id)
+        query_result = await session.execute(query)
+        transaction = query_result.scalar_one_or_none()
+
+        if not transaction:
+            # Транзакция записывается после ответа ЮKassa на создание платежа - вебхук может её обогнать
+            raise LookupError(f"Transaction with payment_id {payment_id} not found")
+        logger.info(f"[Webhook] Найдена транзакция: id={transaction.id}, order_id={transaction.order_id}, user_id={transaction.user_id}, status={transaction.status}")
+
+        # Обновление статуса транзакции. Условный UPDATE: повторная доставка вебхука или две доставки
+        # наперегонки не применят оплату (зачисление на баланс, смену статуса заказа) дважды
+        old_tran_status = transaction.status
+        query = (
+            update(Transaction)
+            .where(
+                Transaction.id == transaction.id,
+                Transaction.status.is_not_distinct_from(old_tran_status),
+                Transaction.status.notin_(TRANSACTION_FINAL_STATUSES),
+            )
+            .values(status=status)
+            .returning(Transaction.id)
+        )
+        query_result = await session.execute(query)
+        if query_result.first() is None:
+            logger.info(f"[Webhook] Транзакция {transaction.id} уже в статусе {old_tran_status}, вебхук пропущен")
+            return
+        logger.info(f"[Webhook] Статус транзакции обновлён: {old_tran_status} -> {status}")
+
+        # Работа с заказом
+        if transaction.order_id:
+            query = select(Order).filter_by(id=transaction.order_id)
+            query_result = await session.execute(query)
+            order = query_result.scalar_one_or_none()
+            if not order:
+                logger.info(f"[Webhook] Заказ с id {transaction.order_id} не найден")
+            else:
+                logger.info(f"[Webhook] Заказ найден: id={order.id}, user_id={order.user_id}, status={order.status}, total_amount={order.total_amount}")
+
+                # Логика по статусу платежа
+                if status == "succeeded":
+                    if await set_order_status(session, order.id, "pending_payment", "created"):
+                        # Корзина очищается в обоих хранилищах; Redis - до коммита, чтобы при его
+                        # недоступности событие было повторено, а не осталась оплаченная корзина
                         query = delete(CartItem).filter_by(user_id=order.user_id)
                         await session.execute(query)
+                        if order.user_id is not None:
+                            await cart_store.clear(order.user_id)
 
-                        logger.info(f"[Webhook] Заказ {order.id}: статус обновлён {old_order_status} -> {order.status}, корзина очищена для user_id {order.user_id}")
-                        notification_data = {
+                        logger.info(f"[Webhook] Заказ {order.id}: статус обновлён {order.status} -> created, корзина очищена для user_id {order.user_id}")
+                        notifications.append({
                             "user_id": order.user_id,
                             "text": f"Ваш заказ #{order.id} успешно оплачен!\n\nВы можете следить за его статусом в разделе Профиль Mini App🤍"
-                        }
-                        redis_client = Redis(host=RedisKeys.HOST, port=RedisKeys.PORT, db=RedisKeys.DATABASE, decode_responses=True)
-                        await redis_client.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps(notification_data))
-                    elif status == "canceled":
-                        old_order_status = order.status
-                        order.status = "canceled"
-                        order.updated_at = datetime.now()
-                        logger.info(f"[Webhook] Заказ {order.id}: статус обновлён {old_order_status} -> {order.status}")
-                        try:
-                            notification_data = {
-                                "user_id": order.user_id,
-                                "text": f"Оплата заказа #{order.id} была отменена."
-                            }
-                            redis_client = Redis(host=RedisKeys.HOST, port=RedisKeys.PORT, db=RedisKeys.DATABASE, decode_responses=True)
-                            await redis_client.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps(notification_data))
-                        except Exception as e:
-                            logger.info(f"[Webhook] Ошибка отправки уведомления Telegram: {str(e)}")
-                    elif status == "waiting_for_capture":
-                        logger.info(f"[Webhook] Платёж ожидает подтверждения (waiting_for_capture) для заказа {order.id}")
-                        # Здесь можете реализовать логику подтверждения платежа через ЮKassa при необходимости
+                        })
+                    else:
+                        logger.warning(f"[Webhook] Заказ {order.id} оплачен, но уже не ожидает оплаты (статус {order.status})")
+                elif status == "canceled":
+                    if await set_order_status(session, order.id, "pending_payment", "canceled"):
+                        logger.info(f"[Webhook] Заказ {order.id}: статус обновлён {order.status} -> canceled")
+                        notifications.append({
+                            "user_id": order.user_id,
+                            "text": f"Оплата заказа #{order.id} была отменена."
+                        })
                     else:
-                        logger.info(f"[Webhook] Неизвестный статус платежа: {status}")
-
-            # Внутри webhook, после проверки transaction и payment
-            if transaction.order_id is None and status == "succeeded":
-                # Пополнение баланса target_user
-                query = select(User).filter_by(user_id=transaction.user_id)
-                query_result = await session.execute(query)
-                target_user = query_result.scalar_one_or_none()
-                if target_user:
-                    target_user.balance = float(target_user.balance or 0) + float(transaction.amount)
-                    await session.commit()
-                    await session.refresh(target_user)
-                    # Отправить уведомление получателю
-                    notification_data = {
-                        "user_id": target_user.user_id,
-                        "text": f"Ваш баланс успешно пополнен на {transaction.amount}₽!"
-                    }
-                    redis_client = Redis(host=RedisKeys.HOST, port=RedisKeys.PORT, db=RedisKeys.DATABASE, decode_responses=True)
-                    await redis_client.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps(notification_data))
-                    # Отправить уведомление плательщику (если есть поле payer_id в transaction)
-                    if hasattr(transaction, "payer_id") and transaction.payer_id:
-                        query = select(User).filter_by(user_id=transaction.payer_id)
-                        query_result = await session.execute(query)
-                        payer = query_result.scalar_one_or_none()
-                        if payer:
-                            display = f"@{target_user.username}" if target_user.username else f"{target_user.user_id}"
-                            notification_data = {
-                                "user_id": payer.user_id,
-                                "text": f"Ваш платёж {transaction.amount}₽ успешно зачислен на баланс пользователя {display}."
-                            }
-                            redis_client = Redis(host=RedisKeys.HOST, port=RedisKeys.PORT, db=RedisKeys.DATABASE, decode_responses=True)
-                            await redis_client.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps(notification_data))
+                        logger.info(f"[Webhook] Заказ {order.id} уже в статусе {order.status}, отмена оплаты не применена")
+                elif status == "waiting_for_capture":
+                    logger.info(f"[Webhook] Платёж ожидает подтверждения (waiting_for_capture) для заказа {order.id}")
+                    # Здесь можете реализовать логику подтверждения платежа через ЮKassa при необходимости
+                else:
+                    logger.info(f"[Webhook] Неизвестный статус платежа: {status}")
+
+        # Внутри webhook, после проверки transaction и payment
+        if transaction.order_id is None and status == "succeeded":
+            # Пополнение баланса target_user - атомарным UPDATE, чтобы не затереть параллельное списание
+            query = (
+                update(User)
+                .where(User.user_id == transaction.user_id)
+                .values(balance=func.coalesce(User.balance, 0) + transaction.amount)
+                .returning(User.user_id, User.username)
+            )
+            query_result = await session.execute(query)
+            target_user = query_result.first()
+            if target_user:
+                # Отправить уведомление получателю
+                notifications.append({
+                    "user_id": target_user.user_id,
+                    "text": f"Ваш баланс успешно пополнен на {transaction.amount}₽!"
+                })
+                # Отправить уведомление плательщику (если есть поле payer_id в transaction)
+                if hasattr(transaction, "payer_id") and transaction.payer_id:
+                    query = select(User).filter_by(user_id=transaction.payer_id)
+                    query_result = await session.execute(query)
+                    payer = query_result.scalar_one_or_none()
+                    if payer:
+                        display = f"@{target_user.username}" if target_user.username else f"{target_user.user_id}"
+                        notifications.append({
+                            "user_id": payer.user_id,
+                            "text": f"Ваш платёж {transaction.amount}₽ успешно зачислен на баланс пользователя {display}."
+                        })
 
-            await session.commit()
-            logger.info(f"[Webhook] Успешно обработан вебхук для payment_id {payment_id}, статус: {status}")
-            return {"ok": True}
-    except HTTPException as e:
-        raise e
-    except Exception as e:
-        logger.info(f"[Webhook] Ошибка обработки вебхука: {e!r}")
-        raise HTTPException(status_code=500, detail=f"Webhook error: {str(e)}")
+        await session.commit()
+
+    # Уведомления - только после коммита, когда оплата точно применена
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for notification_data in notifications:
+                pipe.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps(notification_data))
+            await pipe.execute()
+    except RedisError as e:
+        logger.info(f"[Webhook] Ошибка отправки уведомления Telegram: {e!r}")
+
+    logger.info(f"[Webhook] Успешно обработан вебхук для payment_id {payment_id}, статус: {status}")
 
 
 class UserActionLogIn(BaseModel):
@@ -1343,7 +2094,7 @@ async def log_user_action(log: UserActionLogIn):
             phone_number=log.phone_number,
             action=log.action,
             timestamp=datetime.now(),
-            data=json.dumps(log.data) if log.data else None
+            data=log.data if log.data else None
         )
         session.add(db_log)
         await session.commit()
@@ -1354,19 +2105,23 @@ async def log_user_action(log: UserActionLogIn):
             phone_number=db_log.phone_number,
             action=db_log.action,
             timestamp=db_log.timestamp.isoformat(),
-            data=json.loads(db_log.data) if db_log.data else None
+            data=db_log.data
         )
 
 
+def user_action_logs_query(user_id: Optional[int], action: Optional[str]) -> Select:
+    query = select(UserActionLog)
+    if user_id is not None:
+        query = query.where(UserActionLog.user_id == user_id)
+    if action is not None:
+        query = query.where(UserActionLog.action == action)
+    return query.order_by(UserActionLog.timestamp.desc())
+
+
 @app.get("/user_actions", response_model=List[UserActionLogOut])
 async def get_user_actions(user_id: Optional[int] = None, action: Optional[str] = None, _: dict = Security(get_current_admin)):
     async with async_session() as session:
-        query = select(UserActionLog)
-        if user_id is not None:
-            query = query.where(UserActionLog.user_id == user_id)
-        if action is not None:
-            query = query.where(UserActionLog.action == action)
-        query = query.order_by(UserActionLog.timestamp.desc())
+        query = user_action_logs_query(user_id, action)
         result = await session.execute(query)
         logs = result.scalars().all()
         user_ids = {l.user_id for l in logs}
@@ -1381,7 +2136,7 @@ async def get_user_actions(user_id: Optional[int] = None, action: Optional[str]
                 phone_number=l.phone_number if l.phone_number else user_map.get(l.user_id),
                 action=l.action,
                 timestamp=l.timestamp.isoformat(),
-                data=json.loads(l.data) if l.data else None
+                data=l.data
             ) for l in logs
         ]
 
@@ -1440,6 +2195,18 @@ async def create_source(data: SourceCreate, _: dict = Security(get_current_admin
         )
 
 
+def source_visits_query(source_id: int) -> Select:
+    return select(SourceVisit).where(SourceVisit.source_id == source_id)
+
+
+def source_funnel_query(user_ids: set[int], action: str) -> Select:
+    """Пользователи источника, дошедшие до шага воронки action."""
+    return select(UserActionLog).where(
+        UserActionLog.user_id.in_(user_ids),
+        UserActionLog.action == action
+    ).distinct(UserActionLog.user_id)
+
+
 @app.get("/sources", response_model=List[SourceOut])
 async def get_sources(_: dict = Security(get_current_admin)):
     async with async_session() as session:
@@ -1448,7 +2215,7 @@ async def get_sources(_: dict = Security(get_current_admin)):
         sources = result.scalars().all()
         result_list = []
         for s in sources:
-            query_visits = select(SourceVisit).where(SourceVisit.source_id == s.id)
+            query_visits = source_visits_query(s.id)
             visits = (await session.execute(query_visits)).scalars().all()
             user_ids = {v.user_id for v in visits}
             stats = {
@@ -1460,10 +2227,7 @@ async def get_sources(_: dict = Security(get_current_admin)):
             }
             if user_ids:
                 for action in stats.keys():
-                    query_actions = select(UserActionLog).where(
-                        UserActionLog.user_id.in_(user_ids),
-                        UserActionLog.action == action
-                    ).distinct(UserActionLog.user_id)
+                    query_actions = source_funnel_query(user_ids, action)
                     result_actions = await session.execute(query_actions)
                     stats[action] = len(result_actions.scalars().all())
             visits_count = len(user_ids)
@@ -1478,6 +2242,10 @@ async def get_sources(_: dict = Security(get_current_admin)):
         return result_list
 
 
+def source_visit_query(source_id: int, user_id: int) -> Select:
+    return select(SourceVisit).where(SourceVisit.source_id == source_id, SourceVisit.user_id == user_id)
+
+
 # Public
 @app.post("/source_visit")
 async def log_source_visit(data: SourceVisitLog):
@@ -1487,7 +2255,7 @@ async def log_source_visit(data: SourceVisitLog):
         source = result.scalar_one_or_none()
         if not source:
             raise HTTPException(status_code=404, detail="Source not found")
-        query_existing = select(SourceVisit).where(SourceVisit.source_id == source.id, SourceVisit.user_id == data.user_id)
+        query_existing = source_visit_query(source.id, data.user_id)
         result_existing = await session.execute(query_existing)
         existing = result_existing.scalar_one_or_none()
         if not existing:
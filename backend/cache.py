@@ -0,0 +1,6 @@
+from redis.asyncio import Redis
+
+from env import RedisKeys
+
+# Общее подключение к Redis для всего backend (пул соединений внутри клиента)
+redis = Redis(host=RedisKeys.HOST, port=RedisKeys.PORT, db=RedisKeys.DATABASE, decode_responses=True)
@@ -0,0 +1,384 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from decimal import Decimal
+from typing import Final, Iterable, Optional
+from uuid import uuid4
+
+from redis.exceptions import ResponseError, WatchError
+from sqlalchemy import Select, select, delete, exists, func, any_, all_, bindparam, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+
+from cache import redis
+from database import async_session
+from database.models import CartItem, User
+from database.models.cart_item import CartItemType
+
+logger = logging.getLogger(__name__)
+
+# Корзина пользователя - hash в Redis (id позиции -> JSON позиции), Postgres догоняет его в фоне
+CART_KEY: Final[str] = 'cart:{user_id}'
+LOADED_FIELD: Final[str] = '__loaded__'  # Есть в hash - корзина загружена, даже если пустая
+OWNERS_KEY: Final[str] = 'cart:owners'  # id позиции -> user_id, для DELETE /cart_items/{item_id}
+DIRTY_KEY: Final[str] = 'cart:dirty'  # Пользователи, чьи корзины ещё не записаны в cart_items
+FLUSHING_KEY: Final[str] = 'cart:flushing'  # Забранные на запись, но ещё не записанные
+FLUSH_LOCK_KEY: Final[str] = 'cart:flush_lock'
+OWNERS_CURSOR_KEY: Final[str] = 'cart:owners_cursor'  # Позиция HSCAN по OWNERS_KEY между записями
+
+CART_TTL: Final[int] = 7 * 24 * 60 * 60  # Секунд с последнего обращения
+FLUSH_INTERVAL: Final[int] = 2  # Секунд
+FLUSH_BATCH: Final[int] = 500  # Корзин в одной транзакции
+ID_BLOCK: Final[int] = 1000  # id позиций, резервируемых из последовательности за один запрос
+OWNERS_SWEEP_COUNT: Final[int] = 1000  # Позиций OWNERS_KEY, проверяемых за одну запись
+
+
+def cart_key(user_id: int) -> str:
+    return CART_KEY.format(user_id=user_id)
+
+
+def item_to_dict(item: CartItem) -> dict:
+    return {
+        "id": item.id,
+        "user_id": item.user_id,
+        "item_id": item.item_id,
+        "quantity": item.quantity,
+        "price": float(item.price),
+        "type": CartItemType(item.type).value,
+        "deliveryDate": item.deliveryDate.isoformat() if item.deliveryDate is not None else None,
+        "deliveriesPerMonth": item.deliveriesPerMonth,
+        "subscriptionMonths": item.subscriptionMonths,
+        "title": item.title,
+        "photos": item.photos or [],
+    }
+
+
+def dict_to_row(item: dict) -> dict:
+    return {
+        **item,
+        "price": Decimal(str(item["price"])),
+        "type": CartItemType(item["type"]),
+        "deliveryDate": datetime.fromisoformat(item["deliveryDate"]) if item["deliveryDate"] else None,
+    }
+
+
+def parse_cart(fields: dict) -> list[dict]:
+    items = [json.loads(value) for field, value in fields.items() if field != LOADED_FIELD]
+    return sorted(items, key=lambda item: item["id"])
+
+
+def cart_items_query(user_id: int) -> Select:
+    return select(CartItem).where(CartItem.user_id == user_id)
+
+
+async def load(user_id: int) -> bool:
+    """
+    Загружает корзину из cart_items, если её нет в Redis. False - такого пользователя нет.
+    WATCH не даёт затереть корзину, которую параллельный запрос успел загрузить и изменить.
+    """
+    key = cart_key(user_id)
+    async with async_session() as session:
+        if not await session.scalar(select(exists().where(User.user_id == user_id))):
+            return False
+        result = await session.execute(cart_items_query(user_id))
+        items = [item_to_dict(item) for item in result.scalars()]
+
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.watch(key)
+        if await pipe.exists(key):
+            return True
+        pipe.multi()
+        pipe.hset(key, mapping={LOADED_FIELD: 1, **{str(item["id"]): json.dumps(item) for item in items}})
+        pipe.expire(key, CART_TTL)
+        if items:
+            pipe.hset(OWNERS_KEY, mapping={str(item["id"]): user_id for item in items})
+        try:
+            await pipe.execute()
+        except WatchError:
+            pass
+    return True
+
+
+async def ensure_loaded(user_id: int) -> bool:
+    # EXPIRE заодно продлевает жизнь корзины и отвечает, есть ли она в Redis
+    if await redis.expire(cart_key(user_id), CART_TTL):
+        return True
+    return await load(user_id)
+
+
+async def get_items(user_id: int) -> list[dict]:
+    key = cart_key(user_id)
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.expire(key, CART_TTL)
+        pipe.hgetall(key)
+        found, fields = await pipe.execute()
+    if not found:
+        if not await load(user_id):
+            return []
+        fields = await redis.hgetall(key)
+    return parse_cart(fields)
+
+
+class ItemIdAllocator:
+    """
+    id новых позиций корзины. Воркер резервирует их блоками по ID_BLOCK из последовательности cart_items.id
+    и раздаёт из памяти, так что добавление в корзину обычно не обращается к Postgres, а id не пересекаются
+    ни между воркерами, ни с INSERT без id. Неизрасходованный при остановке воркера остаток блока пропадает.
+    """
+
+    def __init__(self):
+        self._free: list[int] = []
+        self._lock = asyncio.Lock()
+
+    async def take(self, count: int) -> list[int]:
+        async with self._lock:
+            if len(self._free) < count:
+                self._free.extend(await self._reserve(max(ID_BLOCK, count - len(self._free))))
+            ids, self._free = self._free[:count], self._free[count:]
+            return ids
+
+    @staticmethod
+    async def _reserve(count: int) -> list[int]:
+        sequence = func.pg_get_serial_sequence(CartItem.__tablename__, CartItem.id.name)
+        async with async_session() as session:
+            result = await session.execute(select(func.nextval(sequence)).select_from(func.generate_series(1, count)))
+            return list(result.scalars())
+
+
+item_ids = ItemIdAllocator()
+
+
+async def add_item(user_id: int, item: dict) -> Optional[dict]:
+    """Добавляет позицию и возвращает её с id. None - такого пользователя нет."""
+    if not await ensure_loaded(user_id):
+        return None
+    (item_id,) = await item_ids.take(1)
+    item = {**item, "id": item_id, "user_id": user_id}
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(cart_key(user_id), str(item["id"]), json.dumps(item))
+        pipe.hset(OWNERS_KEY, str(item["id"]), user_id)
+        pipe.sadd(DIRTY_KEY, user_id)
+        await pipe.execute()
+    return item
+
+
+async def apply(
+        user_id: int, items: list[tuple[Optional[int], dict]], remove: Iterable[int] = (), replace: bool = True
+) -> Optional[list[dict]]:
+    """
+    Применяет к корзине пачку изменений и возвращает новую корзину. None - такого пользователя нет.
+    items - пары (id позиции или None, поля позиции); позиция с чужим или неизвестным id добавляется как новая.
+    replace=True удаляет всё, чего нет в items, иначе удаляются только позиции из remove.
+    Разница с сохранённой корзиной пишется одним MULTI; если корзину изменили параллельно - повтор по WATCH.
+    """
+    if not await ensure_loaded(user_id):
+        return None
+    key = cart_key(user_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(key)
+                stored = {item["id"]: item for item in parse_cart(await pipe.hgetall(key))}
+
+                cart, changed, submitted = dict(stored), {}, set()
+                new_ids = iter(await item_ids.take(sum(item_id not in stored for item_id, _ in items)))
+                for item_id, fields in items:
+                    if item_id not in stored:
+                        item_id = next(new_ids)
+                    item = {**fields, "id": item_id, "user_id": user_id}
+                    if stored.get(item_id) != item:
+                        changed[item_id] = item
+                    cart[item_id] = item
+                    submitted.add(item_id)
+                if replace:
+                    removed = [item_id for item_id in stored if item_id not in submitted]
+                else:
+                    removed = [item_id for item_id in dict.fromkeys(remove) if item_id in stored and item_id not in submitted]
+                for item_id in removed:
+                    del cart[item_id]
+
+                if changed or removed:
+                    pipe.multi()
+                    if changed:
+                        pipe.hset(key, mapping={str(item_id): json.dumps(item) for item_id, item in changed.items()})
+                        pipe.hset(OWNERS_KEY, mapping={str(item_id): user_id for item_id in changed})
+                    if removed:
+                        pipe.hdel(key, *map(str, removed))
+                        pipe.hdel(OWNERS_KEY, *map(str, removed))
+                    pipe.sadd(DIRTY_KEY, user_id)
+                    await pipe.execute()
+                return sorted(cart.values(), key=lambda item: item["id"])
+            except WatchError:
+                continue
+
+
+async def find_owner(item_id: int) -> Optional[int]:
+    user_id = await redis.hget(OWNERS_KEY, str(item_id))
+    if user_id is not None:
+        return int(user_id)
+    # Корзина владельца ещё не загружалась в Redis
+    async with async_session() as session:
+        return await session.scalar(select(CartItem.user_id).where(CartItem.id == item_id))
+
+
+async def remove_item(item_id: int) -> bool:
+    user_id = await find_owner(item_id)
+    if user_id is None or not await ensure_loaded(user_id):
+        return False
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hdel(cart_key(user_id), str(item_id))
+        pipe.hdel(OWNERS_KEY, str(item_id))
+        pipe.sadd(DIRTY_KEY, user_id)
+        removed, *_ = await pipe.execute()
+    return bool(removed)
+
+
+async def clear(user_id: int) -> None:
+    """Очищает корзину в Redis; cart_items очистится при следующей записи."""
+    key = cart_key(user_id)
+    item_ids = [field for field in await redis.hkeys(key) if field != LOADED_FIELD]
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, LOADED_FIELD, 1)
+        pipe.expire(key, CART_TTL)
+        if item_ids:
+            pipe.hdel(OWNERS_KEY, *item_ids)
+        pipe.sadd(DIRTY_KEY, user_id)
+        await pipe.execute()
+
+
+async def drop(user_ids: list[int]) -> None:
+    """Удаляет корзины удалённых пользователей из Redis, не записывая их в cart_items."""
+    if not user_ids:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.hkeys(cart_key(user_id))
+        item_ids = [field for fields in await pipe.execute() for field in fields if field != LOADED_FIELD]
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.delete(*map(cart_key, user_ids))
+        pipe.srem(DIRTY_KEY, *user_ids)
+        if item_ids:
+            pipe.hdel(OWNERS_KEY, *item_ids)
+        await pipe.execute()
+
+
+async def flush_batch(user_ids: list[int]) -> None:
+    async with redis.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.hgetall(cart_key(user_id))
+        carts = dict(zip(user_ids, await pipe.execute()))
+
+    async with async_session() as session:
+        result = await session.execute(select(User.user_id).where(User.user_id == any_(
+            bindparam("user_ids", user_ids, type_=ARRAY(BigInteger))
+        )))
+        existing = set(result.scalars())
+        # Корзина удалённого пользователя больше не нужна
+        deleted = [user_id for user_id in user_ids if user_id not in existing]
+        if deleted:
+            await redis.delete(*map(cart_key, deleted))
+
+        saved_users, items = [], []
+        for user_id in existing:
+            fields = carts[user_id]
+            if LOADED_FIELD not in fields:
+                logger.error(f"Корзина пользователя {user_id} пропала из Redis до записи в Postgres")
+                continue
+            saved_users.append(user_id)
+            items.extend(parse_cart(fields))
+        if not saved_users:
+            return
+
+        query = delete(CartItem).where(
+            CartItem.user_id == any_(bindparam("saved_users", saved_users, type_=ARRAY(BigInteger))),
+            CartItem.id != all_(bindparam("item_ids", [item["id"] for item in items], type_=ARRAY(BigInteger))),
+        )
+        await session.execute(query, execution_options={"synchronize_session": False})
+        if items:
+            query = insert(CartItem)
+            query = query.on_conflict_do_update(
+                index_elements=[CartItem.id],
+                set_={column: query.excluded[column] for column in items[0] if column != "id"}
+            )
+            await session.execute(query, [dict_to_row(item) for item in items])
+        await session.commit()
+
+
+async def sweep_owners() -> None:
+    """
+    Убирает из OWNERS_KEY позиции корзин, которых больше нет в Redis (истекли по TTL или удалены
+    вместе с пользователем). За раз проверяется один кусок HSCAN, курсор хранится в OWNERS_CURSOR_KEY.
+    Удаляются только поля из прочитанного куска: если корзину тем временем загрузили заново, это позиции
+    из cart_items, и find_owner найдёт их там.
+    """
+    cursor = int(await redis.get(OWNERS_CURSOR_KEY) or 0)
+    cursor, owners = await redis.hscan(OWNERS_KEY, cursor, count=OWNERS_SWEEP_COUNT)
+    await redis.set(OWNERS_CURSOR_KEY, cursor)
+    if not owners:
+        return
+    user_ids = sorted(set(owners.values()))
+    async with redis.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.exists(cart_key(user_id))
+        alive = {user_id for user_id, found in zip(user_ids, await pipe.execute()) if found}
+    expired = [item_id for item_id, user_id in owners.items() if user_id not in alive]
+    if expired:
+        await redis.hdel(OWNERS_KEY, *expired)
+
+
+async def acquire_lock() -> Optional[str]:
+    """Токен блокировки записи или None, если её держит другой воркер."""
+    token = uuid4().hex
+    if await redis.set(FLUSH_LOCK_KEY, token, nx=True, ex=FLUSH_INTERVAL * 30):
+        return token
+    return None
+
+
+async def release_lock(token: str) -> None:
+    # Блокировку, истёкшую и взятую другим воркером, не трогаем
+    async with redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(FLUSH_LOCK_KEY)
+            if await pipe.get(FLUSH_LOCK_KEY) == token:
+                pipe.multi()
+                pipe.delete(FLUSH_LOCK_KEY)
+                await pipe.execute()
+        except WatchError:
+            pass
+
+
+async def flush() -> None:
+    """
+    Записывает изменённые корзины в cart_items: удаляет пропавшие позиции и upsert-ит остальные.
+    Как и в launches, множество DIRTY_KEY переименовывается целиком, а при падении воркера
+    FLUSHING_KEY будет записан повторно.
+    """
+    token = await acquire_lock()
+    if token is None:
+        return
+    try:
+        await sweep_owners()
+        if not await redis.exists(FLUSHING_KEY):
+            try:
+                await redis.rename(DIRTY_KEY, FLUSHING_KEY)
+            except ResponseError:  # Изменений нет
+                return
+        user_ids = sorted(int(user_id) for user_id in await redis.smembers(FLUSHING_KEY))
+        for i in range(0, len(user_ids), FLUSH_BATCH):
+            await flush_batch(user_ids[i:i + FLUSH_BATCH])
+        await redis.delete(FLUSHING_KEY)
+    finally:
+        await release_lock(token)
+
+
+async def run() -> None:
+    """Фоновая задача воркера: запись корзин из Redis в Postgres."""
+    while True:
+        try:
+            await flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка записи корзин в Postgres: {e!r}")
+        await asyncio.sleep(FLUSH_INTERVAL)
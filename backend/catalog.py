@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from redis.exceptions import RedisError
+
+from cache import redis
+from env import RedisKeys
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: int
+    items: list[dict]
+    products: dict[int, dict]  # Те же товары по id
+    body: bytes  # Готовый JSON ответа GET /products
+    etag: str
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Проверяет заголовок If-None-Match (список ETag через запятую или *)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return etag in candidates
+
+
+class CatalogCache:
+    """
+    Снимок каталога товаров в памяти воркера.
+    Версия каталога хранится в Redis и увеличивается при каждом изменении товаров,
+    а сообщение в канале CATALOG_CHANNEL сбрасывает снимок на всех воркерах.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[list[dict]]]):
+        self._loader = loader
+        self._snapshot: CatalogSnapshot | None = None
+        self._generation = 0  # Защита от сохранения снимка, устаревшего во время загрузки
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> CatalogSnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        async with self._lock:
+            if self._snapshot is not None:
+                return self._snapshot
+            return await self._load()
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._snapshot = None
+
+    async def bump(self) -> None:
+        """Вызывается после коммита изменений товаров."""
+        self.invalidate()
+        try:
+            version = await redis.incr(CATALOG_VERSION_KEY)
+            await redis.publish(RedisKeys.CATALOG_CHANNEL, version)
+        except RedisError as e:
+            logger.error(f"Не удалось опубликовать новую версию каталога: {e!r}")
+
+    async def listen(self) -> None:
+        """Фоновая задача: сбрасывает снимок по сообщениям от других воркеров."""
+        while True:
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.subscribe(RedisKeys.CATALOG_CHANNEL)
+                # Пока не были подписаны, могли пропустить изменения
+                self.invalidate()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.invalidate()
+            except RedisError as e:
+                logger.error(f"Потеряна подписка на {RedisKeys.CATALOG_CHANNEL}: {e!r}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def _load(self) -> CatalogSnapshot:
+        generation = self._generation
+        try:
+            version = int(await redis.get(CATALOG_VERSION_KEY) or 0)
+        except RedisError:
+            version = 0
+
+        items = await self._loader()
+        body = json.dumps(items, ensure_ascii=False, separators=(',', ':')).encode()
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        snapshot = CatalogSnapshot(
+            version=version,
+            items=items,
+            products={item['id']: item for item in items},
+            body=body,
+            etag=f'"{version}-{digest}"'
+        )
+
+        if generation == self._generation:
+            self._snapshot = snapshot
+        return snapshot
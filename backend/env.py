@@ -11,6 +11,9 @@ class ServerKeys:
     SERVER_HOST: Final[str] = environ.get('SERVER_HOST', default="0.0.0.0")
     SERVER_PORT: Final[int] = int(environ.get('SERVER_PORT', default=8080))
 
+    MEDIA_ROOT: Final[str] = environ.get('MEDIA_ROOT', default='media')  # Каталог для превью фотографий
+    MEDIA_URL: Final[str] = environ.get('MEDIA_URL', default='/media')  # Публичный адрес этого каталога
+
     ALLOW_PROXY: Final[bool] = bool(environ.get("ALLOW_PROXY", default=False))
     ALLOWED_PROXY_IP: Final[list[str]] = list(environ.get("ALLOWED_PROXY_IP", default='').split(','))
 
@@ -18,6 +21,7 @@ class ServerKeys:
 class YookassaKeys:
     SHOP_ID: Final[str] = environ.get('YOOKASSA_SHOP_ID')
     SECRET_KEY: Final[str] = environ.get('YOOKASSA_SECRET_KEY')
+    API_URL: Final[str] = environ.get('YOOKASSA_API_URL', default='https://api.yookassa.ru/v3')  # Для scripts.fake_yookassa
 
 
 # noinspection DuplicatedCode
@@ -28,3 +32,4 @@ class RedisKeys:
 
     URL: Final[str] = f'redis://{HOST}:{PORT}/{DATABASE}'
     NOTIFICATION_CHANNEL: Final[str] = environ.get('NOTIFICATION_CHANNEL', default='notifications')
+    CATALOG_CHANNEL: Final[str] = environ.get('CATALOG_CHANNEL', default='catalog_updates')
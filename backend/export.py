@@ -0,0 +1,169 @@
+import csv
+import io
+import json
+import logging
+import zlib
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional, Literal, AsyncIterator
+
+from fastapi import APIRouter, Security, Query
+from sqlalchemy import select, func, Select
+from sqlalchemy.dialects.postgresql import JSONB, aggregate_order_by
+from starlette.responses import StreamingResponse
+
+from admin import get_current_admin
+from database import async_session
+from database.models import Order, OrderItem, User, UserActionLog
+
+logger = logging.getLogger(__name__)
+
+export_router = APIRouter(prefix='/export', tags=['export'], dependencies=[Security(get_current_admin)])
+
+EXPORT_BATCH = 1000  # Строк из серверного курсора за раз и в одном куске ответа
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def order_items_column():
+    """Позиции заказа из order_items в формате Order.items; для ещё не перенесённых заказов - сам Order.items."""
+    item = func.jsonb_build_object(
+        'product_id', OrderItem.product_id,
+        'deliveries_per_month', OrderItem.deliveries_per_month,
+        'subscription_months', OrderItem.subscription_months,
+        'deliveryDate', OrderItem.delivery_date,
+        'price', OrderItem.price,
+        'title', OrderItem.title,
+    )
+    items = (
+        select(func.jsonb_agg(aggregate_order_by(item, OrderItem.position), type_=JSONB))
+        .where(OrderItem.order_id == Order.id)
+        .scalar_subquery()
+    )
+    return func.coalesce(items, Order.items, type_=JSONB).label('items')
+
+
+def orders_query(since: Optional[datetime], until: Optional[datetime]) -> Select:
+    query = select(
+        Order.id, Order.user_id, User.phone_number, Order.status, Order.total_amount, Order.order_type,
+        Order.created_at, Order.updated_at, Order.fio, Order.phone, Order.email, Order.comment,
+        order_items_column(),
+    ).outerjoin(User, User.user_id == Order.user_id).order_by(Order.id)
+    if since is not None:
+        query = query.where(Order.created_at >= since)
+    if until is not None:
+        query = query.where(Order.created_at < until)
+    return query
+
+
+def users_query(since: Optional[datetime], until: Optional[datetime]) -> Select:
+    query = select(
+        User.id, User.user_id, User.username, User.first_name, User.last_name, User.phone_number,
+        User.join_time, User.balance, User.daily_launches, User.total_launches, User.blocked, User.source_param,
+    ).order_by(User.id)
+    if since is not None:
+        query = query.where(User.join_time >= since)
+    if until is not None:
+        query = query.where(User.join_time < until)
+    return query
+
+
+def user_actions_query(since: Optional[datetime], until: Optional[datetime]) -> Select:
+    query = select(
+        UserActionLog.id, UserActionLog.user_id, UserActionLog.phone_number, UserActionLog.action,
+        UserActionLog.timestamp, UserActionLog.data,
+    ).order_by(UserActionLog.id)
+    if since is not None:
+        query = query.where(UserActionLog.timestamp >= since)
+    if until is not None:
+        query = query.where(UserActionLog.timestamp < until)
+    return query
+
+
+QUERIES = {
+    'orders': orders_query,
+    'users': users_query,
+    'user_actions': user_actions_query,
+}
+
+
+def to_plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def to_csv_cell(value):
+    value = to_plain(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+async def export_rows(query: Select, fmt: str) -> AsyncIterator[str]:
+    """Строки выгрузки кусками по EXPORT_BATCH, читаются из серверного курсора - память не зависит от размера таблицы."""
+    async with async_session() as session:
+        result = await session.stream(query.execution_options(yield_per=EXPORT_BATCH))
+        columns = list(result.keys())
+
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            async for partition in result.partitions():
+                writer.writerows([to_csv_cell(value) for value in row] for row in partition)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():  # Строк нет - остался только заголовок
+                yield buffer.getvalue()
+        else:
+            async for partition in result.partitions():
+                yield ''.join(
+                    json.dumps({c: to_plain(v) for c, v in zip(columns, row)}, ensure_ascii=False) + '\n'
+                    for row in partition
+                )
+
+
+async def gzipped(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # 31 - формат gzip
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def encoded(chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        yield chunk.encode('utf-8')
+
+
+@export_router.get("/{kind}")
+async def export(
+        kind: Literal["orders", "users", "user_actions"],
+        fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+        gzip: bool = False,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+):
+    """Выгрузка таблицы целиком (или за период) для бухгалтерии."""
+    logger.info(f"Выгрузка {kind} в {fmt}, since={since}, until={until}")
+    body = encoded(export_rows(QUERIES[kind](since, until), fmt))
+    filename = f"{kind}_{datetime.now():%Y%m%d_%H%M%S}.{fmt}"
+    if gzip:
+        body = gzipped(body)
+        filename += '.gz'
+        media_type = 'application/gzip'
+    else:
+        media_type = MEDIA_TYPES[fmt]
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
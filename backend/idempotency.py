@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Final, Optional
+
+from redis.exceptions import RedisError
+
+from cache import redis
+
+logger = logging.getLogger(__name__)
+
+# Результат запроса по ключу идемпотентности: {"state": "in_flight" | "complete", "fingerprint", "response"}
+IDEMPOTENCY_KEY: Final[str] = 'idempotency:{scope}:{key}'
+IN_FLIGHT_TTL: Final[int] = 60  # Секунд; дольше всех попыток запроса к ЮKassa
+RESULT_TTL: Final[int] = 24 * 60 * 60  # Столько же ЮKassa помнит Idempotence-Key
+MAX_KEY_LENGTH: Final[int] = 128
+SAVE_ATTEMPTS: Final[int] = 3  # Попыток сохранить готовый ответ
+
+
+class IdempotencyError(Exception):
+    pass
+
+
+class RequestInProgress(IdempotencyError):
+    """Запрос с этим ключом ещё выполняется."""
+
+
+class KeyReused(IdempotencyError):
+    """Ключ уже использован для запроса с другими параметрами."""
+
+
+def fingerprint(payload: Any) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def provider_key(scope: str, key: str) -> str:
+    """Idempotence-Key для ЮKassa: постоянный для ключа запроса и не длиннее 64 символов."""
+    return hashlib.sha256(f'{scope}:{key}'.encode()).hexdigest()
+
+
+async def run_once(
+        scope: str, key: str, payload: Any, handler: Callable[[str], Awaitable[dict]], ttl: int = RESULT_TTL
+) -> dict:
+    """
+    Выполняет handler один раз на ключ и кэширует его ответ на ttl секунд; повтор получает сохранённый ответ.
+    handler получает Idempotence-Key для ЮKassa. Если handler упал, ключ освобождается - запрос можно повторить.
+    Если не удалось сохранить ответ, ключ остаётся "in_flight" до IN_FLIGHT_TTL, и повторы получают 409,
+    а не выполняют handler заново.
+    """
+    redis_key = IDEMPOTENCY_KEY.format(scope=scope, key=key)
+    request_fingerprint = fingerprint(payload)
+    record = json.dumps({"state": "in_flight", "fingerprint": request_fingerprint})
+
+    if not await redis.set(redis_key, record, nx=True, ex=IN_FLIGHT_TTL):
+        stored = await redis.get(redis_key)
+        if stored is None:  # Истёк между SET и GET
+            return await run_once(scope, key, payload, handler, ttl)
+        stored = json.loads(stored)
+        if stored["fingerprint"] != request_fingerprint:
+            raise KeyReused(key)
+        if stored["state"] != "complete":
+            raise RequestInProgress(key)
+        return stored["response"]
+
+    try:
+        response = await handler(provider_key(scope, key))
+    except BaseException:
+        await redis.delete(redis_key)
+        raise
+
+    record = json.dumps({"state": "complete", "fingerprint": request_fingerprint, "response": response}, default=str)
+    for attempt in range(SAVE_ATTEMPTS):
+        try:
+            await redis.set(redis_key, record, ex=ttl)
+            break
+        except RedisError as e:
+            if attempt == SAVE_ATTEMPTS - 1:
+                logger.error(f"Не удалось сохранить ответ по ключу {redis_key}: {e!r}")
+            else:
+                await asyncio.sleep(0.1 * 2 ** attempt)
+    return response
@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import logging
+import os
+from io import BytesIO
+from pathlib import Path
+from typing import Final
+
+import aiohttp
+from PIL import Image, ImageOps
+from starlette.staticfiles import StaticFiles
+
+logger = logging.getLogger(__name__)
+
+# Ширины превью для сетки каталога и карточки товара
+DERIVATIVE_WIDTHS: Final[tuple[int, ...]] = (320, 640)
+DERIVATIVE_FORMATS: Final[dict[str, tuple[str, dict]]] = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+MAX_SOURCE_SIZE: Final[int] = 20 * 1024 * 1024  # 20 MB
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """Файлы с хэшем содержимого в имени никогда не меняются - кэшируем навсегда."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+class ImageService:
+    """
+    Скачивает оригиналы фотографий и сохраняет уменьшенные копии на локальный диск.
+    Имя файла - sha256 оригинала, поэтому повторная обработка того же фото ничего не делает.
+    """
+
+    def __init__(self, root: str, base_url: str):
+        self.root = Path(root)
+        self.base_url = base_url.rstrip('/')
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    async def derivatives(self, url: str) -> dict[str, dict[str, str]]:
+        """Возвращает {"<ширина>": {"webp": url, "jpeg": url}} для фото по ссылке."""
+        data = await self._fetch(url)
+        digest = hashlib.sha256(data).hexdigest()
+        return await asyncio.to_thread(self._render, data, digest)
+
+    async def _fetch(self, url: str) -> bytes:
+        async with self._session.get(url) as response:
+            response.raise_for_status()
+            if response.content_length and response.content_length > MAX_SOURCE_SIZE:
+                raise ValueError(f"Image is too large: {response.content_length} bytes")
+            data = await response.content.read(MAX_SOURCE_SIZE + 1)
+            if len(data) > MAX_SOURCE_SIZE:
+                raise ValueError("Image is too large")
+            return data
+
+    def _render(self, data: bytes, digest: str) -> dict[str, dict[str, str]]:
+        directory = self.root / digest[:2]
+        directory.mkdir(exist_ok=True)
+
+        result = {}
+        image = None
+        try:
+            for width in DERIVATIVE_WIDTHS:
+                urls = {}
+                for ext, (image_format, options) in DERIVATIVE_FORMATS.items():
+                    name = f"{digest}_{width}.{ext}"
+                    path = directory / name
+                    if not path.exists():
+                        if image is None:
+                            image = ImageOps.exif_transpose(Image.open(BytesIO(data))).convert('RGB')
+                        resized = image.copy()
+                        resized.thumbnail((width, width * 4), Image.Resampling.LANCZOS)  # Без увеличения маленьких фото
+                        tmp_path = path.with_suffix(f'.{ext}.tmp')
+                        resized.save(tmp_path, image_format, **options)
+                        os.replace(tmp_path, path)
+                    urls[ext] = f"{self.base_url}/{digest[:2]}/{name}"
+                result[str(width)] = urls
+        finally:
+            if image is not None:
+                image.close()
+        return result
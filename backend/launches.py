@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Final, Optional
+from uuid import uuid4
+from zoneinfo import ZoneInfo
+
+from redis.exceptions import RedisError, WatchError
+from sqlalchemy import update, delete, values, column, func, BigInteger, Integer
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import redis
+from database import async_session
+from database.models import User, LaunchBatch
+
+logger = logging.getLogger(__name__)
+
+# Запуски Mini App копятся в Redis (user_id -> число) и периодически переносятся в users
+PENDING_KEY: Final[str] = 'launches:pending'
+FLUSHING_KEY: Final[str] = 'launches:flushing'  # Забранные на перенос, но ещё не записанные
+FLUSHING_ID_KEY: Final[str] = 'launches:flushing_id'  # id пачки FLUSHING_KEY в launch_batches
+FLUSH_LOCK_KEY: Final[str] = 'launches:flush_lock'
+RESET_KEY: Final[str] = 'launches:reset:{day}'  # Ставится после того, как сброс за день закоммичен
+
+FLUSH_INTERVAL: Final[int] = 10  # Секунд
+FLUSH_BATCH: Final[int] = 5000  # Строк в одном UPDATE (2 параметра на строку)
+BATCH_RETENTION: Final[timedelta] = timedelta(days=7)  # Сколько хранить id применённых пачек
+SHOP_TIMEZONE: Final[ZoneInfo] = ZoneInfo('Europe/Moscow')  # Сутки лимита запусков - по времени магазина, а не сервера
+
+
+async def record_launch(user_id: int) -> None:
+    try:
+        await redis.hincrby(PENDING_KEY, str(user_id), 1)
+    except RedisError as e:
+        logger.error(f"Не удалось учесть запуск пользователя {user_id}: {e!r}")
+
+
+async def pending_launches() -> dict[int, int]:
+    """Запуски, ещё не перенесённые в Postgres."""
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(PENDING_KEY)
+            pipe.hgetall(FLUSHING_KEY)
+            pending, flushing = await pipe.execute()
+    except RedisError as e:
+        logger.error(f"Не удалось получить несохранённые запуски: {e!r}")
+        return {}
+    result = {}
+    for deltas in (pending, flushing):
+        for user_id, delta in deltas.items():
+            result[int(user_id)] = result.get(int(user_id), 0) + int(delta)
+    return result
+
+
+async def acquire_lock() -> Optional[str]:
+    """Токен блокировки переноса или None, если её держит другой воркер."""
+    token = uuid4().hex
+    if await redis.set(FLUSH_LOCK_KEY, token, nx=True, ex=FLUSH_INTERVAL * 6):
+        return token
+    return None
+
+
+async def release_lock(token: str) -> None:
+    # Блокировку, истёкшую и взятую другим воркером, не трогаем
+    async with redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(FLUSH_LOCK_KEY)
+            if await pipe.get(FLUSH_LOCK_KEY) == token:
+                pipe.multi()
+                pipe.delete(FLUSH_LOCK_KEY)
+                await pipe.execute()
+        except WatchError:
+            pass
+
+
+async def claim_batch() -> Optional[str]:
+    """
+    id пачки в FLUSHING_KEY. Новые запуски переименовываются в FLUSHING_KEY целиком и
+    копятся уже в новом ключе; пачка, оставшаяся после сбоя, переносится повторно с тем же id.
+    """
+    batch_id = await redis.get(FLUSHING_ID_KEY)
+    if batch_id is not None and await redis.exists(FLUSHING_KEY):
+        return batch_id
+    if not await redis.exists(FLUSHING_KEY) and not await redis.exists(PENDING_KEY):
+        return None
+    batch_id = uuid4().hex
+    async with redis.pipeline(transaction=True) as pipe:
+        if not await redis.exists(FLUSHING_KEY):
+            pipe.rename(PENDING_KEY, FLUSHING_KEY)
+        pipe.set(FLUSHING_ID_KEY, batch_id)
+        await pipe.execute()
+    return batch_id
+
+
+async def mark_applied(session, batch_id: str) -> bool:
+    """Записывает пачку в launch_batches в транзакции переноса. False - она уже применена."""
+    query = insert(LaunchBatch).values(id=batch_id).on_conflict_do_nothing().returning(LaunchBatch.id)
+    result = await session.execute(query)
+    return result.first() is not None
+
+
+async def flush_locked() -> None:
+    batch_id = await claim_batch()
+    if batch_id is None:  # Нет новых запусков
+        return
+    deltas = [(int(user_id), int(delta)) for user_id, delta in (await redis.hgetall(FLUSHING_KEY)).items()]
+
+    async with async_session() as session:
+        if await mark_applied(session, batch_id):
+            for i in range(0, len(deltas), FLUSH_BATCH):
+                batch = values(
+                    column('user_id', BigInteger), column('delta', Integer), name='launches'
+                ).data(deltas[i:i + FLUSH_BATCH])
+                query = update(User).where(User.user_id == batch.c.user_id).values(
+                    daily_launches=func.coalesce(User.daily_launches, 0) + batch.c.delta,
+                    total_launches=func.coalesce(User.total_launches, 0) + batch.c.delta,
+                )
+                await session.execute(query, execution_options={"synchronize_session": False})
+            await session.commit()
+        else:
+            logger.info(f"Пачка запусков {batch_id} уже перенесена")
+    await redis.delete(FLUSHING_KEY, FLUSHING_ID_KEY)
+
+
+async def reset_locked() -> None:
+    """
+    Обнуляет daily_launches раз в сутки. Отметка дня пишется в launch_batches той же транзакцией,
+    что и обнуление, а в Redis - только после коммита: упавший сброс повторится, применённый - нет.
+    """
+    day = datetime.now(SHOP_TIMEZONE).date().isoformat()
+    reset_key = RESET_KEY.format(day=day)
+    if await redis.exists(reset_key):
+        return
+    # Вчерашние запуски должны попасть во вчерашний счётчик
+    await flush_locked()
+    async with async_session() as session:
+        if await mark_applied(session, f'reset:{day}'):
+            await session.execute(update(User).where(User.daily_launches != 0).values(daily_launches=0))
+            await session.execute(delete(LaunchBatch).where(LaunchBatch.applied_at < func.now() - BATCH_RETENTION))
+            await session.commit()
+            logger.info("Дневные счётчики запусков обнулены")
+    await redis.set(reset_key, 1, ex=2 * 24 * 60 * 60)
+
+
+async def flush(reset: bool = False) -> None:
+    """Переносит накопленные запуски в users (и при reset - обнуляет дневные счётчики) под блокировкой."""
+    token = await acquire_lock()
+    if token is None:
+        return
+    try:
+        if reset:
+            await reset_locked()
+        await flush_locked()
+    finally:
+        await release_lock(token)
+
+
+async def run() -> None:
+    """Фоновая задача воркера: перенос запусков и ежедневный сброс."""
+    while True:
+        try:
+            await flush(reset=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка переноса счётчиков запусков: {e!r}")
+        await asyncio.sleep(FLUSH_INTERVAL)
@@ -0,0 +1,55 @@
+from datetime import datetime
+from typing import Optional
+
+from database.models import Order, OrderItem
+
+
+def parse_delivery_date(value) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def order_item_rows(order_id: int, items: list) -> list[dict]:
+    """
+    Строки order_items для позиций заказа в формате CartOrderItem.
+    Старые заказы могли хранить deliveriesPerMonth/subscriptionMonths в camelCase.
+    """
+    rows = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        dpm = item.get("deliveries_per_month") or item.get("deliveriesPerMonth")
+        sm = item.get("subscription_months") or item.get("subscriptionMonths")
+        rows.append({
+            "order_id": order_id,
+            "position": position,
+            "product_id": int(item.get("product_id") or 0),
+            "title": item.get("title"),
+            "price": round(float(item.get("price") or 0)),
+            "deliveries_per_month": int(dpm) if dpm else None,
+            "subscription_months": int(sm) if sm else None,
+            "delivery_date": parse_delivery_date(item.get("deliveryDate")),
+        })
+    return rows
+
+
+def item_to_dict(item: OrderItem) -> dict:
+    return {
+        "product_id": item.product_id,
+        "deliveries_per_month": item.deliveries_per_month,
+        "subscription_months": item.subscription_months,
+        "deliveryDate": item.delivery_date.isoformat() if item.delivery_date else None,
+        "price": item.price,
+        "title": item.title,
+    }
+
+
+def order_items_out(order: Order) -> Optional[list]:
+    """Позиции заказа для OrderOut.items; order_items должны быть загружены (selectinload)."""
+    if order.order_items:
+        return [item_to_dict(item) for item in order.order_items]
+    return order.items  # Заказ ещё не перенесён в order_items
@@ -0,0 +1,39 @@
+import base64
+import json
+from typing import Any
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Заголовок со следующим курсором для keyset-пагинации
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Примерное число строк в таблице (по статистике планировщика, без COUNT(*))
+TOTAL_COUNT_ESTIMATE_HEADER = "X-Total-Count-Estimate"
+
+
+def encode_cursor(*values: Any) -> str:
+    """Непрозрачный курсор из значений ключа сортировки последней строки страницы."""
+    raw = json.dumps(values, default=str, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+async def estimate_table_rows(session: AsyncSession, table_name: str) -> int:
+    """Оценка числа строк из pg_class.reltuples, обновляется VACUUM/ANALYZE."""
+    result = await session.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table_name)"),
+        {"table_name": table_name}
+    )
+    # -1 - таблица ещё ни разу не анализировалась
+    return max(result.scalar() or 0, 0)
@@ -0,0 +1,45 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final
+
+import bcrypt
+
+# bcrypt отпускает GIL, поэтому хэширование в потоках не мешает event loop
+PASSWORD_WORKERS: Final[int] = 2
+# Сверх этого числа ожидающих проверок новые запросы сразу отклоняются, а не копятся в очереди
+MAX_PENDING: Final[int] = 16
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix='bcrypt')
+_pending = 0
+
+# Хэш для проверки пароля несуществующего админа - чтобы ответ занимал столько же времени.
+# Стоимость та же, что у bcrypt.gensalt() по умолчанию
+_DUMMY_HASH: Final[bytes] = b'$2b$12$9aj9ihcS7EQ5Ej.AyrxiKeTa4HZKs9OY.z5hAQa1G8eBTS8xfNLYm'
+
+
+class PasswordHasherBusy(Exception):
+    """Очередь хэширования переполнена."""
+
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= MAX_PENDING:
+        raise PasswordHasherBusy()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    hashed = await _run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt())
+    return hashed.decode('utf-8')
+
+
+async def check_password(password: str, password_hash: str | None) -> bool:
+    """Если password_hash не задан (админ не найден), всё равно тратит время на проверку и возвращает False."""
+    if password_hash is None:
+        await _run(bcrypt.checkpw, password.encode('utf-8'), _DUMMY_HASH)
+        return False
+    return await _run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
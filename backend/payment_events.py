@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import time
+import zlib
+from typing import Awaitable, Callable, Final
+from uuid import uuid4
+
+from redis.exceptions import ResponseError, WatchError
+
+from cache import redis
+
+logger = logging.getLogger(__name__)
+
+# Вебхуки ЮKassa копятся в Redis Streams и применяются воркером. Поток выбирается по payment_id,
+# поэтому события одного платежа обрабатываются строго по порядку
+STREAM_KEY: Final[str] = 'yookassa:events:{partition}'
+LEASE_KEY: Final[str] = 'yookassa:events:{partition}:lease'  # Какой воркер сейчас обрабатывает поток
+ATTEMPTS_KEY: Final[str] = 'yookassa:events:attempts'  # id события -> число неудачных попыток
+DEAD_LETTER_KEY: Final[str] = 'yookassa:events:dead'
+GROUP: Final[str] = 'webhook'
+CONSUMER: Final[str] = 'lease-holder'  # Один consumer на поток: события упавшего держателя аренды достаются следующему
+
+PARTITIONS: Final[int] = 16
+BATCH: Final[int] = 100  # Событий за одно чтение потока
+BLOCK_TIMEOUT: Final[float] = 5  # Секунд ожидания новых событий в XREADGROUP BLOCK
+IDLE_INTERVAL: Final[float] = 1  # Секунд между попытками, если читать нечего
+LEASE_TTL: Final[int] = 30  # Секунд; продлевается перед каждым событием и его подтверждением
+LEASE_RENEW_INTERVAL: Final[float] = 10  # Секунд между продлениями всех аренд
+MAX_ATTEMPTS: Final[int] = 6
+RETRY_DELAY: Final[float] = 1  # Секунд, удваивается с каждой попыткой
+DEAD_LETTER_MAXLEN: Final[int] = 10_000
+
+Handler = Callable[[dict], Awaitable[None]]
+
+WORKER_ID: Final[str] = uuid4().hex
+
+
+def partition_of(payment_id: str) -> int:
+    return zlib.crc32(payment_id.encode()) % PARTITIONS
+
+
+async def publish(payment_id: str, payload: dict) -> None:
+    stream = STREAM_KEY.format(partition=partition_of(payment_id))
+    await redis.xadd(stream, {"payment_id": payment_id, "payload": json.dumps(payload)})
+
+
+async def ensure_group(stream: str) -> None:
+    try:
+        await redis.xgroup_create(stream, GROUP, id='0', mkstream=True)
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+async def acquire_lease(partition: int) -> bool:
+    key = LEASE_KEY.format(partition=partition)
+    if await redis.set(key, WORKER_ID, nx=True, ex=LEASE_TTL):
+        return True
+    # Продлеваем только свою аренду: истёкшую и взятую другим воркером не трогаем
+    async with redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(key)
+            if await pipe.get(key) != WORKER_ID:
+                return False
+            pipe.multi()
+            pipe.expire(key, LEASE_TTL)
+            await pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+async def renew_leases() -> set[int]:
+    """
+    Берёт свободные аренды и продлевает свои - по одному pipeline на шаг вместо запросов на каждый поток.
+    Возвращает потоки, аренду которых держит этот воркер.
+    """
+    keys = [LEASE_KEY.format(partition=partition) for partition in range(PARTITIONS)]
+    async with redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.set(key, WORKER_ID, nx=True, ex=LEASE_TTL)
+        for key in keys:
+            pipe.get(key)
+        results = await pipe.execute()
+    acquired = {partition for partition, ok in enumerate(results[:PARTITIONS]) if ok}
+    owned = [
+        partition for partition, holder in enumerate(results[PARTITIONS:])
+        if holder == WORKER_ID and partition not in acquired
+    ]
+    if not owned:
+        return acquired
+    # Продлеваем только свои аренды: истёкшие и взятые другим воркером не трогаем
+    async with redis.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(*(keys[partition] for partition in owned))
+            holders = await pipe.mget(*(keys[partition] for partition in owned))
+            owned = [partition for partition, holder in zip(owned, holders) if holder == WORKER_ID]
+            pipe.multi()
+            for partition in owned:
+                pipe.expire(keys[partition], LEASE_TTL)
+            await pipe.execute()
+        except WatchError:
+            owned = []  # Проверим заново при следующем продлении
+    return acquired | set(owned)
+
+
+class PartitionWorker:
+    """
+    Обработка одного потока. Поток читает только держатель аренды LEASE_KEY, от имени общего
+    consumer'а CONSUMER - поэтому неподтверждённые события упавшего воркера достаются следующему.
+    Упавшее событие блокирует поток до повтора, чтобы следующее событие того же платежа
+    не обогнало его; после MAX_ATTEMPTS оно уходит в DEAD_LETTER_KEY.
+    Аренда продлевается перед каждым событием и подтверждением: пачка может обрабатываться дольше
+    LEASE_TTL, и потерявший аренду воркер сразу останавливается, а не обрабатывает события параллельно
+    с новым держателем.
+    """
+
+    def __init__(self, partition: int):
+        self.partition = partition
+        self.stream = STREAM_KEY.format(partition=partition)
+        self.retry_at = 0.0
+        self.group_ready = False
+        self.leased = False
+        # Есть взятые ранее, но не подтверждённые события: после получения аренды или сбоя
+        self.has_pending = True
+
+    def ready(self) -> bool:
+        return self.leased and time.monotonic() >= self.retry_at
+
+    async def prepare(self) -> None:
+        if not self.group_ready:
+            await ensure_group(self.stream)
+            self.group_ready = True
+
+    async def read_pending(self) -> list[tuple[str, dict]]:
+        await self.prepare()
+        try:
+            response = await redis.xreadgroup(GROUP, CONSUMER, {self.stream: '0'}, count=BATCH)
+        except ResponseError:
+            self.group_ready = False  # Например, Redis очищен вместе с группой
+            raise
+        entries = response[0][1] if response else []
+        self.has_pending = bool(entries)
+        return entries
+
+    async def process(self, handler: Handler, entries: list[tuple[str, dict]]) -> int:
+        processed = 0
+        for event_id, fields in entries:
+            if fields:  # Пустые поля - событие удалено из потока, осталось только подтвердить
+                if not await self.holds_lease():
+                    return processed
+                try:
+                    await handler(json.loads(fields["payload"]))
+                except Exception as e:
+                    if not await self.failed(event_id, fields, e):
+                        self.has_pending = True  # Повтор начнётся с этого события
+                        return processed
+            # Без аренды не подтверждаем: событие повторит новый держатель, вебхуки применяются повторно без вреда
+            if not await self.holds_lease():
+                return processed
+            await self.ack(event_id)
+            processed += 1
+        return processed
+
+    async def holds_lease(self) -> bool:
+        if await acquire_lease(self.partition):
+            return True
+        self.leased = False
+        self.has_pending = True  # Если аренда вернётся, начнём с неподтверждённых
+        logger.info(f"[Webhook] Аренда потока {self.stream} перешла к другому воркеру, обработка остановлена")
+        return False
+
+    async def failed(self, event_id: str, fields: dict, error: Exception) -> bool:
+        """False - событие будет повторено; True - отправлено в DEAD_LETTER_KEY."""
+        attempts = await redis.hincrby(ATTEMPTS_KEY, f'{self.partition}:{event_id}', 1)
+        if attempts < MAX_ATTEMPTS:
+            delay = RETRY_DELAY * 2 ** (attempts - 1)
+            logger.info(
+                f"[Webhook] Событие {event_id} платежа {fields.get('payment_id')} не обработано "
+                f"(попытка {attempts}/{MAX_ATTEMPTS}), повтор через {delay} с: {error!r}"
+            )
+            self.retry_at = time.monotonic() + delay
+            return False
+        logger.error(f"[Webhook] Событие {event_id} платежа {fields.get('payment_id')} отправлено в {DEAD_LETTER_KEY}: {error!r}")
+        await redis.xadd(
+            DEAD_LETTER_KEY,
+            {**fields, "stream": self.stream, "event_id": event_id, "error": repr(error)},
+            maxlen=DEAD_LETTER_MAXLEN,
+            approximate=True,
+        )
+        return True
+
+    async def ack(self, event_id: str) -> None:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.xack(self.stream, GROUP, event_id)
+            pipe.xdel(self.stream, event_id)
+            pipe.hdel(ATTEMPTS_KEY, f'{self.partition}:{event_id}')
+            await pipe.execute()
+
+
+async def read_new(workers: list[PartitionWorker], timeout: float) -> dict[str, list[tuple[str, dict]]]:
+    """Новые события всех потоков workers одним XREADGROUP BLOCK: без событий воркер ждёт в Redis, а не опрашивает его."""
+    for worker in workers:
+        await worker.prepare()
+    try:
+        response = await redis.xreadgroup(
+            GROUP, CONSUMER, {worker.stream: '>' for worker in workers}, count=BATCH, block=max(int(timeout * 1000), 1)
+        )
+    except ResponseError:
+        for worker in workers:
+            worker.group_ready = False
+        raise
+    return {stream: entries for stream, entries in response or []}
+
+
+async def run(handler: Handler) -> None:
+    """
+    Фоновая задача воркера: применение вебхуков ЮKassa из потоков.
+    Аренды продлеваются раз в LEASE_RENEW_INTERVAL, а между продлениями воркер ждёт новые события
+    своих потоков в XREADGROUP BLOCK.
+    """
+    workers = [PartitionWorker(partition) for partition in range(PARTITIONS)]
+    renew_at = 0.0
+    while True:
+        try:
+            if time.monotonic() >= renew_at:
+                held = await renew_leases()
+                for worker in workers:
+                    if worker.partition in held and not worker.leased:
+                        worker.has_pending = True
+                    worker.leased = worker.partition in held
+                renew_at = time.monotonic() + LEASE_RENEW_INTERVAL
+
+            ready = [worker for worker in workers if worker.ready()]
+            processed = 0
+            for worker in ready:
+                if worker.has_pending:
+                    processed += await worker.process(handler, await worker.read_pending())
+            waiting = [worker for worker in ready if not worker.has_pending and worker.ready()]
+            if processed or not waiting:
+                if not processed:
+                    await asyncio.sleep(min(IDLE_INTERVAL, max(renew_at - time.monotonic(), 0)))
+                continue
+
+            timeout = min(BLOCK_TIMEOUT, renew_at - time.monotonic())
+            if timeout <= 0:
+                continue
+            events = await read_new(waiting, timeout)
+            for worker in waiting:
+                if worker.stream in events:
+                    await worker.process(handler, events[worker.stream])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка обработки вебхуков ЮKassa: {e!r}")
+            await asyncio.sleep(IDLE_INTERVAL)
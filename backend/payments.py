@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Final, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT: Final[aiohttp.ClientTimeout] = aiohttp.ClientTimeout(total=10, connect=3)
+MAX_CONNECTIONS: Final[int] = 100
+MAX_ATTEMPTS: Final[int] = 3
+RETRY_DELAY: Final[float] = 0.5  # Секунд, удваивается с каждой попыткой
+RETRY_STATUSES: Final[frozenset[int]] = frozenset({202, 429, 500, 502, 503, 504})  # 202 - ЮKassa ещё обрабатывает запрос
+
+BREAKER_THRESHOLD: Final[int] = 5  # Неудачных запросов подряд, после которых ЮKassa считается недоступной
+BREAKER_COOLDOWN: Final[float] = 30  # Секунд без запросов к ЮKassa после срабатывания
+
+
+class PaymentGatewayError(Exception):
+    """ЮKassa отклонила запрос или не ответила за все попытки."""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class PaymentGatewayUnavailable(PaymentGatewayError):
+    """Предохранитель разомкнут - запрос к ЮKassa даже не отправлялся."""
+
+
+@dataclass(frozen=True)
+class CreatedPayment:
+    id: str
+    status: str
+    confirmation_url: Optional[str]
+
+
+class CircuitBreaker:
+    """
+    После BREAKER_THRESHOLD неудач подряд размыкается на BREAKER_COOLDOWN секунд: запросы сразу получают ошибку,
+    а не ждут таймаута. Затем пропускает один пробный запрос за период - его успех замыкает цепь обратно.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at < self.cooldown:
+            return False
+        self._opened_at = now  # Пробный запрос; остальные ждут его результата или следующего периода
+        return True
+
+    def success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+
+    def failure(self) -> None:
+        self._failures += 1
+        if self._opened_at is None and self._failures >= self.threshold:
+            logger.error(f"ЮKassa недоступна, запросы приостановлены на {self.cooldown} с")
+        if self._opened_at is not None or self._failures >= self.threshold:
+            self._opened_at = time.monotonic()
+
+
+class YookassaClient:
+    """
+    Асинхронный клиент API ЮKassa на общем пуле соединений.
+    Повторы безопасны: все попытки идут с одним Idempotence-Key, и ЮKassa не создаст второй платёж.
+    """
+
+    def __init__(self, shop_id: str, secret_key: str, api_url: str):
+        self.shop_id = shop_id
+        self.secret_key = secret_key
+        self.api_url = api_url.rstrip('/')
+        self.breaker = CircuitBreaker()
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self) -> None:
+        self._session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(self.shop_id or '', self.secret_key or ''),
+            timeout=REQUEST_TIMEOUT,
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    async def create_payment(self, payload: dict, idempotence_key: str) -> CreatedPayment:
+        data = await self._request('POST', '/payments', payload, idempotence_key)
+        return CreatedPayment(
+            id=data['id'],
+            status=data['status'],
+            confirmation_url=(data.get('confirmation') or {}).get('confirmation_url'),
+        )
+
+    async def _request(self, method: str, path: str, payload: dict, idempotence_key: str) -> dict:
+        if not self.breaker.allow():
+            raise PaymentGatewayUnavailable("Payment provider is unavailable")
+
+        delay = RETRY_DELAY
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                async with self._session.request(
+                        method, self.api_url + path, json=payload, headers={'Idempotence-Key': idempotence_key}
+                ) as response:
+                    if response.status not in RETRY_STATUSES:
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError:
+                            data = {'description': f"HTTP {response.status}"}
+                        # ЮKassa ответила - значит, доступна, даже если отказала по существу запроса (4xx)
+                        self.breaker.success()
+                        if response.status >= 400:
+                            raise PaymentGatewayError(data.get('description') or str(data), response.status)
+                        return data
+                    error = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+
+            logger.info(f"ЮKassa: попытка {attempt}/{MAX_ATTEMPTS} {method} {path} не удалась: {error}")
+            if attempt < MAX_ATTEMPTS:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        self.breaker.failure()
+        raise PaymentGatewayError("Payment provider did not respond")
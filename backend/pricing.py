@@ -0,0 +1,80 @@
+from typing import Final, Iterable
+
+# Цены, которые раньше считал только Mini App (Menu.tsx, Cart.tsx)
+DELIVERY_PRICE: Final[int] = 500  # За одну доставку
+DELIVERY_TITLE: Final[str] = 'Доставка (Москва в пределах МКАД)'
+EXTRAS: Final[dict[str, tuple[str, int]]] = {
+    'vaza': ('Ваза к доставке (1 шт)', 500),
+    'sekator': ('Секатор к доставке (1 шт)', 500),
+}
+# (букетов в подписке не меньше, скидка в процентах) - от большей к меньшей
+SUBSCRIPTION_DISCOUNTS: Final[tuple[tuple[int, int], ...]] = ((12, 15), (8, 10), (4, 5))
+
+SERVICE_PRODUCT_ID: Final[int] = 0  # product_id доставки и доп. товаров в позициях заказа
+
+
+class PricingError(ValueError):
+    pass
+
+
+def subscription_discount(bouquets: int) -> int:
+    for min_bouquets, percent in SUBSCRIPTION_DISCOUNTS:
+        if bouquets >= min_bouquets:
+            return percent
+    return 0
+
+
+def item_price(price_per_delivery: int, deliveries_per_month: int, subscription_months: int) -> int:
+    """Цена позиции со скидкой за подписку, округлённая до рубля половиной вверх, как Math.round в Mini App."""
+    bouquets = deliveries_per_month * subscription_months
+    total = price_per_delivery * bouquets * (100 - subscription_discount(bouquets))
+    return (total * 2 + 100) // 200
+
+
+def price_order(products: dict[int, dict], items: Iterable[dict], extras: Iterable[str] = ()) -> tuple[list[dict], int]:
+    """
+    Пересчитывает позиции заказа по ценам каталога (products - снимок каталога по id).
+    Цены и названия от клиента игнорируются, строки доставки и доп. товаров (product_id 0) собираются заново.
+    Возвращает позиции в формате CartOrderItem и итоговую сумму.
+    """
+    priced = []
+    deliveries = 0
+    for item in items:
+        product_id = item['product_id']
+        if product_id == SERVICE_PRODUCT_ID:
+            continue
+        product = products.get(product_id)
+        if product is None:
+            raise PricingError(f"Product {product_id} not found")
+
+        dpm = item.get('deliveries_per_month') or 1
+        sm = item.get('subscription_months') or 1
+        if not (1 <= dpm <= product['max_deliveries'] and 1 <= sm <= product['max_months']):
+            raise PricingError(f"Invalid subscription for product {product_id}")
+
+        deliveries += dpm * sm
+        priced.append({
+            **item,
+            'price': item_price(product['price_per_delivery'], dpm, sm),
+            'title': product['title'],
+        })
+    if not priced:
+        raise PricingError("Order has no products")
+
+    for extra in dict.fromkeys(extras):
+        title, price = EXTRAS[extra]
+        priced.append(service_item(title, price))
+    priced.append(service_item(DELIVERY_TITLE, DELIVERY_PRICE * deliveries))
+
+    return priced, sum(item['price'] for item in priced)
+
+
+def service_item(title: str, price: int) -> dict:
+    return {
+        'product_id': SERVICE_PRODUCT_ID,
+        'deliveries_per_month': None,
+        'subscription_months': None,
+        'deliveryDate': None,
+        'price': price,
+        'title': title,
+    }
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Final
+
+from redis.exceptions import RedisError
+from sqlalchemy import select, update, Select
+
+from cache import redis
+from database import async_session
+from database.models import Delivery, Order
+from env import RedisKeys
+
+logger = logging.getLogger(__name__)
+
+REMINDER_INTERVAL: Final[int] = 60  # Секунд между проверками
+REMINDER_AHEAD: Final[timedelta] = timedelta(days=1)  # За сколько до доставки напоминать
+REMINDER_BATCH: Final[int] = 500  # Доставок в одной транзакции и одном pipeline
+
+
+def reminder_text(delivery_date: datetime, order_id: int) -> str:
+    return (
+        f"Напоминаем: {delivery_date:%d.%m} доставка по заказу #{order_id}. "
+        f"Если планы изменились, напишите в поддержку."
+    )
+
+
+def due_reminders_query(now: datetime) -> Select:
+    return (
+        select(Delivery.id, Delivery.delivery_date, Delivery.order_id, Order.user_id)
+        .join(Order, Order.id == Delivery.order_id)
+        .where(
+            Delivery.status == "scheduled",
+            Delivery.reminder_sent_at.is_(None),
+            Delivery.delivery_date > now,
+            Delivery.delivery_date <= now + REMINDER_AHEAD,
+            Order.status.notin_(["pending_payment", "canceled"]),
+        )
+        .order_by(Delivery.delivery_date)
+        .limit(REMINDER_BATCH)
+        .with_for_update(of=Delivery, skip_locked=True)
+    )
+
+
+async def send_batch() -> int:
+    """
+    Забирает пачку доставок, по которым пора напомнить, и отправляет напоминания.
+    FOR UPDATE SKIP LOCKED не даёт двум репликам взять одни и те же строки, а reminder_sent_at
+    записывается в той же транзакции - после коммита доставка больше не попадёт в выборку.
+    Напоминания публикуются только после коммита: лучше потерять напоминание, чем отправить его дважды.
+    """
+    now = datetime.now()
+    async with async_session() as session:
+        query = due_reminders_query(now)
+        result = await session.execute(query)
+        rows = result.all()
+        if not rows:
+            return 0
+
+        await session.execute(
+            update(Delivery).where(Delivery.id.in_([r.id for r in rows])).values(reminder_sent_at=now),
+            execution_options={"synchronize_session": False}
+        )
+        await session.commit()
+
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for r in rows:
+                if r.user_id is None:
+                    continue
+                pipe.publish(RedisKeys.NOTIFICATION_CHANNEL, json.dumps({
+                    "user_id": r.user_id,
+                    "text": reminder_text(r.delivery_date, r.order_id),
+                }))
+            await pipe.execute()
+    except RedisError as e:
+        logger.error(f"Не удалось отправить напоминания о доставке ({len(rows)}), они уже отмечены отправленными: {e!r}")
+        return len(rows)
+    logger.info(f"Отправлено напоминаний о доставке: {len(rows)}")
+    return len(rows)
+
+
+async def run() -> None:
+    """Фоновая задача воркера: напоминания о доставках на завтра."""
+    while True:
+        try:
+            while await send_batch() == REMINDER_BATCH:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка отправки напоминаний о доставке: {e!r}")
+        await asyncio.sleep(REMINDER_INTERVAL)
@@ -8,6 +8,7 @@ from sqlalchemy import select
 
 from database import async_session
 from database.models import Admin
+from passwords import hash_password
 
 
 def generate_password(length=32):
@@ -36,14 +37,14 @@ async def create_admin(username: str, password: str | None, email: str):
             password = generate_password()
             print(f"Сгенерированный пароль: {password}")
 
-        # Хэшируем пароль
+        # Хэшируем пароль тем же способом, что и при проверке в API
         admin = Admin(
             username=username,
             email=email,
+            password_hash=await hash_password(password),
             is_active=True,
             created_at=datetime.now()
         )
-        admin.set_password(password)
 
         session.add(admin)
         await session.commit()
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import sys
+
+from sqlalchemy import Select, select, insert, exists, func
+
+from database import async_session
+from database.models import Order, OrderItem
+from order_items import order_item_rows
+
+RETRY_DELAY = 5  # Секунд между проходами, пока остаются заблокированные заказы
+REPORT_LIMIT = 20  # Сколько id непереносённых заказов вывести
+
+
+def pending_orders_query() -> Select:
+    """Заказы со старыми позициями в orders.items, у которых ещё нет order_items."""
+    return (
+        select(Order.id, Order.items)
+        .where(
+            Order.items.isnot(None),
+            func.jsonb_typeof(Order.items) == 'array',
+            ~exists().where(OrderItem.order_id == Order.id),
+        )
+        .order_by(Order.id)
+    )
+
+
+async def backfill_pass(batch_size: int) -> int:
+    """
+    Один проход по заказам в порядке id. Заказы, заблокированные другими транзакциями, пропускаются
+    (SKIP LOCKED) - их подберёт следующий проход.
+    """
+    last_id = 0
+    migrated = 0
+    while True:
+        async with async_session() as session:
+            query = (
+                pending_orders_query()
+                .where(Order.id > last_id)
+                .limit(batch_size)
+                .with_for_update(of=Order, skip_locked=True)
+            )
+            result = await session.execute(query)
+            orders = result.all()
+            if not orders:
+                break
+
+            rows = [row for order_id, items in orders for row in order_item_rows(order_id, items)]
+            if rows:
+                await session.execute(insert(OrderItem), rows)
+            await session.commit()
+
+        last_id = orders[-1].id
+        migrated += len(orders)
+        print(f"Перенесено заказов: {migrated} (последний id={last_id})")
+    return migrated
+
+
+async def remaining_order_ids() -> list[int]:
+    async with async_session() as session:
+        result = await session.execute(select(pending_orders_query().subquery().c.id))
+        return list(result.scalars())
+
+
+async def backfill(batch_size: int, passes: int) -> bool:
+    """
+    Переносит позиции старых заказов из orders.items в order_items.
+    Каждая пачка - отдельная транзакция, а заказы, у которых уже есть order_items, пропускаются,
+    поэтому скрипт можно прервать и запустить снова. Пропущенные из-за блокировок заказы переносятся
+    повторными проходами; False - после всех проходов часть заказов так и не перенесена.
+    """
+    migrated = 0
+    for number in range(1, passes + 1):
+        migrated += await backfill_pass(batch_size)
+        remaining = await remaining_order_ids()
+        if not remaining:
+            print(f"Готово, перенесено заказов: {migrated}")
+            return True
+        print(f"Проход {number}: не перенесено заказов, заблокированных другими транзакциями: {len(remaining)}")
+        if number < passes:
+            await asyncio.sleep(RETRY_DELAY)
+
+    ids = ', '.join(map(str, remaining[:REPORT_LIMIT])) + (', ...' if len(remaining) > REPORT_LIMIT else '')
+    print(f"Перенесено заказов: {migrated}, НЕ перенесено: {len(remaining)} (id: {ids}). Запустите скрипт ещё раз")
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос позиций заказов из orders.items в таблицу order_items.")
+    parser.add_argument("-B", "--batch-size", type=int, default=500, help="Заказов в одной транзакции")
+    parser.add_argument("-P", "--passes", type=int, default=5, help="Проходов, пока остаются заблокированные заказы")
+
+    args = parser.parse_args()
+    ok = asyncio.run(backfill(args.batch_size, args.passes))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import json
+import sys
+from datetime import datetime
+
+from sqlalchemy import select, func, text, Select
+
+import api
+import cart_store
+import reminders
+from database import engine
+from database.models import User, OrderItem, Transaction, Delivery, SourceVisit
+
+# Синтетические данные: на каждого пользователя 2 заказа, по 4 доставки на заказ, 5 действий и т.д.
+SEED_SQL = [
+    """
+    INSERT INTO users (user_id, username, phone_number, join_time, balance, blocked, daily_launches, total_launches,
+                       source_param)
+    SELECT 1000000 + g, 'user' || g, '+7999' || lpad(g::text, 7, '0'), now() - g * interval '1 minute', g % 1000,
+           g % 50 = 0, 0, g % 100, 'source' || (g % 200)
+    FROM generate_series(1, :users) g
+    """,
+    """
+    INSERT INTO orders (user_id, status, total_amount, order_type, created_at, updated_at)
+    SELECT 1000000 + 1 + g % :users,
+           (ARRAY['pending_payment', 'created', 'assembling', 'delivered', 'delivered', 'delivered', 'canceled'])[g % 7 + 1],
+           1000 + g % 5000, CASE WHEN g % 3 = 0 THEN 'subscription' ELSE 'one-time' END,
+           now() - g * interval '10 minutes', now() - g * interval '10 minutes'
+    FROM generate_series(1, 2 * :users) g
+    """,
+    """
+    INSERT INTO order_items (order_id, position, product_id, title, price, deliveries_per_month, subscription_months)
+    SELECT id, 0, 1 + id % 200, 'Букет', total_amount, 1, 1 FROM orders
+    """,
+    """
+    INSERT INTO deliveries (order_id, delivery_date, status)
+    SELECT id, created_at + k * interval '7 days', CASE WHEN k = 3 THEN 'scheduled' ELSE 'delivered' END
+    FROM orders, generate_series(0, 3) k
+    """,
+    """
+    INSERT INTO transactions (user_id, order_id, amount, status, payment_id, transaction_type, timestamp)
+    SELECT user_id, id, total_amount, 'succeeded', 'payment-' || id, 'yookassa', created_at FROM orders
+    """,
+    """
+    INSERT INTO cart_items (user_id, item_id, quantity, price, type, "deliveriesPerMonth", "subscriptionMonths",
+                            title, photos)
+    SELECT 1000000 + g, (1 + g % 200)::text, 1, 1000, 'one-time', 1, 1, 'Букет', '[]'
+    FROM generate_series(1, :users, 2) g
+    """,
+    """
+    INSERT INTO user_action_logs (user_id, action, timestamp)
+    SELECT 1000000 + g, action, now() - g * interval '1 minute'
+    FROM generate_series(1, :users) g,
+         unnest(ARRAY['enter_bot', 'submit_phone', 'open_miniapp', 'add_to_cart', 'payment']) action
+    """,
+    """
+    INSERT INTO sources (start_param, created_at) SELECT 'source' || g, now() FROM generate_series(0, 199) g
+    """,
+    """
+    INSERT INTO source_visits (source_id, user_id, visited_at)
+    SELECT s.id, 1000000 + g, now() - g * interval '1 minute'
+    FROM generate_series(1, :users) g JOIN sources s ON s.start_param = 'source' || (g % 200)
+    """,
+]
+
+
+async def seed(users: int):
+    async with engine.begin() as conn:
+        if await conn.scalar(select(func.count()).select_from(User)):
+            raise SystemExit("Таблица users не пуста - заполнять можно только пустую локальную базу")
+        for sql in SEED_SQL:
+            await conn.execute(text(sql), {"users": users})
+    # ANALYZE не работает внутри транзакции блока begin()
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("ANALYZE"))
+    print(f"Заполнено: {users} пользователей")
+
+
+async def plan_queries() -> dict[str, Select]:
+    """Запросы эндпоинтов с селективными фильтрами - каждый должен идти по индексу."""
+    async with engine.connect() as conn:
+        user_id = await conn.scalar(select(func.percentile_disc(0.5).within_group(User.user_id)))
+        order_id, payment_id = (await conn.execute(
+            select(Transaction.order_id, Transaction.payment_id).where(Transaction.user_id == user_id).limit(1)
+        )).one()
+        source_id = await conn.scalar(select(SourceVisit.source_id).where(SourceVisit.user_id == user_id).limit(1))
+        phone_digits = await conn.scalar(select(User.phone_digits).where(User.user_id == user_id))
+        day = await conn.scalar(select(func.percentile_disc(0.5).within_group(Delivery.delivery_date)))
+
+    # Запросы строят те же функции, что и эндпоинты. selectinload догружает связи отдельным
+    # запросом с order_id IN (...) - он проверяется отдельной строкой
+    user_ids = {user_id + i for i in range(0, 2000, 40)}
+    users_page, _ = api.users_list_query(None, None, "balance_desc", None, 50)
+    return {
+        "GET /cart_items (загрузка корзины)": cart_store.cart_items_query(user_id),
+        "GET /users/{user_id}/orders": api.user_orders_query(user_id, None, 20),
+        "GET /users/{user_id}/orders (доставки)": select(Delivery).where(Delivery.order_id.in_([order_id])),
+        "GET /users/{user_id}/orders (позиции)": select(OrderItem).where(OrderItem.order_id.in_([order_id])),
+        "GET /orders/{order_id}/deliveries": api.order_deliveries_query(order_id),
+        "GET /api/user/{user_id}/transactions": api.user_transactions_query(user_id),
+        "POST /api/yookassa/webhook": api.transaction_by_payment_query(payment_id),
+        "GET /user_actions?user_id&action": api.user_action_logs_query(user_id, "payment"),
+        "GET /sources (визиты)": api.source_visits_query(source_id),
+        "GET /sources (воронка)": api.source_funnel_query(user_ids, "payment"),
+        "POST /source_visit": api.source_visit_query(source_id, user_id),
+        "GET /users/search": api.user_search_query(phone_digits[:8], 20),
+        "GET /users?sort=balance_desc": users_page,
+        "GET /deliveries/calendar (день)": api.delivery_calendar_query(day.date(), day.date()),
+        "reminders.send_batch": reminders.due_reminders_query(datetime.now()),
+    }
+
+
+def seq_scans(plan: dict) -> list[str]:
+    found = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+
+async def check() -> bool:
+    queries = await plan_queries()
+    ok = True
+    async with engine.connect() as conn:
+        for name, query in queries.items():
+            sql = str(query.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+            result = await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}")
+            explain = result.scalar()
+            if isinstance(explain, str):  # Без кодека json у драйвера
+                explain = json.loads(explain)
+            plan = explain[0]["Plan"]
+            tables = seq_scans(plan)
+            status = f"SEQ SCAN {', '.join(tables)}" if tables else "ok"
+            print(f"{status:<40} {plan['Node Type']:<20} cost={plan['Total Cost']:<10} {name}")
+            ok = ok and not tables
+    return ok
+
+
+async def run(seed_users: int | None) -> bool:
+    try:
+        if seed_users:
+            await seed(seed_users)
+        return await check()
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Проверка планов запросов эндпоинтов: падает, если какой-то запрос читает таблицу целиком (Seq Scan)."
+    )
+    parser.add_argument("--seed", action="store_true", help="Сначала заполнить ПУСТУЮ локальную базу синтетическими данными")
+    parser.add_argument("-N", "--users", type=int, default=100_000, help="Пользователей при заполнении")
+
+    args = parser.parse_args()
+    ok = asyncio.run(run(args.users if args.seed else None))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import random
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+
+class FakeYookassa:
+    """
+    Минимальная замена API ЮKassa для нагрузочных тестов оплаты без выхода в интернет.
+    Поддерживает создание платежа (с Idempotence-Key, как настоящий API) и его получение;
+    страница /checkout/{id} имитирует оплату и возвращает на return_url.
+    """
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payments: dict[str, dict] = {}
+        self.idempotent: dict[str, dict] = {}
+
+    async def _simulate(self) -> None:
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.error_rate:
+            raise web.HTTPServiceUnavailable()
+
+    async def create_payment(self, request: web.Request) -> web.Response:
+        await self._simulate()
+        key = request.headers.get('Idempotence-Key')
+        if not key:
+            return web.json_response(
+                {'type': 'error', 'code': 'invalid_request', 'description': 'Idempotence-Key header is required'},
+                status=400
+            )
+        if key in self.idempotent:
+            return web.json_response(self.idempotent[key])
+
+        body = await request.json()
+        payment_id = str(uuid.uuid4())
+        payment = {
+            'id': payment_id,
+            'status': 'pending',
+            'paid': False,
+            'test': True,
+            'amount': body.get('amount'),
+            'description': body.get('description'),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'confirmation': {
+                'type': 'redirect',
+                'return_url': (body.get('confirmation') or {}).get('return_url'),
+                'confirmation_url': f"{request.url.origin()}/checkout/{payment_id}",
+            },
+        }
+        self.payments[payment_id] = payment
+        self.idempotent[key] = payment
+        return web.json_response(payment)
+
+    async def get_payment(self, request: web.Request) -> web.Response:
+        await self._simulate()
+        payment = self.payments.get(request.match_info['payment_id'])
+        if payment is None:
+            return web.json_response({'type': 'error', 'code': 'not_found'}, status=404)
+        return web.json_response(payment)
+
+    async def checkout(self, request: web.Request) -> web.Response:
+        payment = self.payments.get(request.match_info['payment_id'])
+        if payment is None:
+            raise web.HTTPNotFound()
+        payment.update(status='succeeded', paid=True)
+        raise web.HTTPFound(payment['confirmation']['return_url'] or '/')
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v3/payments', self.create_payment)
+        app.router.add_get('/v3/payments/{payment_id}', self.get_payment)
+        app.router.add_get('/checkout/{payment_id}', self.checkout)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Локальный фейковый API ЮKassa. Backend переключается на него через YOOKASSA_API_URL=http://<host>:<port>/v3"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.2, help="Средняя задержка ответа, секунд")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 503 (0..1)")
+
+    args = parser.parse_args()
+    web.run_app(FakeYookassa(args.latency, args.error_rate).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
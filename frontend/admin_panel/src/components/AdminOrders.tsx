@@ -76,7 +76,8 @@ function DeliveriesModal({ order, open, onClose }: DeliveriesModalProps) {
     }, [open, order]);
 
     const handleStatusChange = (deliveryId: number, status: string) => {
-        api.patch(`/deliveries/${deliveryId}/status`, { status })
+        const expected_status = deliveries.find(d => d.id === deliveryId)?.status;
+        api.patch(`/deliveries/${deliveryId}/status`, { status, expected_status })
             .then(res => {
                 setDeliveries(prev =>
                     prev.map(d => d.id === deliveryId ? { ...d, status: res.data.status } : d)
@@ -206,15 +207,18 @@ export default function AdminOrders() {
     };
 
     const handleStatusChange = async (orderId: number, newStatus: string) => {
+        const expected_status = orders.find(order => order.id === orderId)?.status;
         try {
-            const res = await api.patch(`/orders/${orderId}/status`, { status: newStatus });
+            const res = await api.patch(`/orders/${orderId}/status`, { status: newStatus, expected_status });
             setOrders(prev =>
                 prev.map(order =>
                     order.id === orderId ? { ...order, status: res.data.status } : order
                 )
             );
-        } catch {
-            setError("Ошибка смены статуса");
+        } catch (e: any) {
+            setError(e?.response?.status === 409
+                ? "Статус заказа уже изменён или такой переход недоступен, обновите список"
+                : "Ошибка смены статуса");
         }
     };
 
@@ -152,9 +152,31 @@ function MetricCard({
     );
 }
 
+// Пользователи, пришедшие с начала текущего месяца: страницы /users от новых к старым,
+// пока не дойдём до более ранних. Всего пользователей - оценка из X-Total-Count-Estimate
+async function fetchUsersSinceMonthStart() {
+    const now = new Date();
+    const monthStart = new Date(now.getFullYear(), now.getMonth(), 1).getTime();
+    const users: any[] = [];
+    let cursor: string | null = null;
+    let total = 0;
+    do {
+        const res: any = await api.get("/users", {
+            params: { sort: "join_time_desc", limit: 500, ...(cursor ? { cursor } : {}) },
+        });
+        total = Number(res.headers["x-total-count-estimate"]) || 0;
+        const page: any[] = res.data || [];
+        const fresh = page.filter((u) => u.join_time && new Date(u.join_time).getTime() >= monthStart);
+        users.push(...fresh);
+        cursor = fresh.length === page.length ? res.headers["x-next-cursor"] ?? null : null;
+    } while (cursor);
+    return { users, total: Math.max(total, users.length) };
+}
+
 const Dashboard: React.FC = () => {
     // Состояния
     const [users, setUsers] = useState<any[]>([]);
+    const [totalUsers, setTotalUsers] = useState(0);
     const [orders, setOrders] = useState<any[]>([]);
     const [products, setProducts] = useState<any[]>([]);
     const [loading, setLoading] = useState(true);
@@ -164,12 +186,13 @@ const Dashboard: React.FC = () => {
     useEffect(() => {
         setLoading(true);
         Promise.all([
-            api.get("/users"),
+            fetchUsersSinceMonthStart(),
             api.get("/orders"),
             api.get("/products")
         ])
             .then(([usersRes, ordersRes, productsRes]) => {
-                setUsers(usersRes.data || []);
+                setUsers(usersRes.users);
+                setTotalUsers(usersRes.total);
                 setOrders(ordersRes.data || []);
                 setProducts(productsRes.data || []);
                 setError(null);
@@ -235,8 +258,6 @@ const Dashboard: React.FC = () => {
         ? revenueInMonth / completedOrdersInMonth.length
         : 0;
 
-    // Всего пользователей
-    const totalUsers = users.length;
     // Всего заказов
     const totalOrders = orders.length;
     // Всего доставок (можно == totalOrders)
@@ -253,7 +274,8 @@ const Dashboard: React.FC = () => {
         const counts: Record<number, { user: any; count: number }> = {};
         orders.forEach((o: any) => {
             if (!counts[o.user_id]) {
-                const u = users.find((u) => u.user_id === o.user_id);
+                // Загружены только новые пользователи - для остальных показываем user_id
+                const u = users.find((u) => u.user_id === o.user_id) ?? { user_id: o.user_id };
                 counts[o.user_id] = { user: u, count: 0 };
             }
             counts[o.user_id].count += 1;
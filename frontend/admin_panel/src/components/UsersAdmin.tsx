@@ -100,6 +100,16 @@ const AddRandomButton = ({ onClick }: { onClick: () => void }) => (
 
 type SortType = "balance_desc" | "balance_asc" | "date_desc" | "date_asc" | "";
 
+// Сортировка на сервере: страницы идут по X-Next-Cursor в том же порядке
+const SERVER_SORT: Record<SortType, string> = {
+    balance_desc: "balance_desc",
+    balance_asc: "balance_asc",
+    date_desc: "join_time_desc",
+    date_asc: "join_time_asc",
+    "": "id",
+};
+const USERS_PAGE_SIZE = 100;
+
 const dialogPaperSx = {
     borderRadius: 12,
     boxShadow: "0 12px 48px -16px rgb(84,133,228,0.18)",
@@ -140,6 +150,8 @@ const UsersAdmin: React.FC = () => {
     const [loading, setLoading] = useState(false);
     const [search, setSearch] = useState("");
     const [sort, setSort] = useState<SortType>("");
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
+    const [loadingMore, setLoadingMore] = useState(false);
     const [editBalanceOpen, setEditBalanceOpen] = useState(false);
     const [editUser, setEditUser] = useState<UserCardData | null>(null);
     const [newBalance, setNewBalance] = useState<number>(0);
@@ -154,23 +166,44 @@ const UsersAdmin: React.FC = () => {
 
     const isMobile = useMediaQuery("(max-width:600px)");
 
-    // Загрузка пользователей из API
+    // Загрузка страницы пользователей из API
+    const fetchUsersPage = (cursor: string | null) =>
+        api.get<UserCardData[]>('/users', {
+            params: { sort: SERVER_SORT[sort], limit: USERS_PAGE_SIZE, ...(cursor ? { cursor } : {}) },
+        });
+
     const fetchUsers = async () => {
         setLoading(true);
         try {
-            const res = await api.get<UserCardData[]>('/users');
+            const res = await fetchUsersPage(null);
             setUsers(res.data);
+            setNextCursor(res.headers["x-next-cursor"] ?? null);
         } catch (e) {
             console.error("Ошибка при загрузке пользователей:", e);
             setUsers([]);
+            setNextCursor(null);
         } finally {
             setLoading(false);
         }
     };
 
+    const fetchMoreUsers = async () => {
+        if (!nextCursor) return;
+        setLoadingMore(true);
+        try {
+            const res = await fetchUsersPage(nextCursor);
+            setUsers(prev => [...prev, ...res.data]);
+            setNextCursor(res.headers["x-next-cursor"] ?? null);
+        } catch (e) {
+            console.error("Ошибка при загрузке пользователей:", e);
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     useEffect(() => {
         fetchUsers();
-    }, []);
+    }, [sort]);
 
     // Генерация рандомного пользователя (только фронт)
     const handleRandomUser = () => {
@@ -299,15 +332,8 @@ const UsersAdmin: React.FC = () => {
             (u.join_time && formatDate(u.join_time).includes(search))
         );
 
-    const sortedUsers = [...filteredUsers].sort((a, b) => {
-        if (sort === "balance_desc") return (Number(b.balance) || 0) - (Number(a.balance) || 0);
-        if (sort === "balance_asc") return (Number(a.balance) || 0) - (Number(b.balance) || 0);
-        if (sort === "date_desc")
-            return new Date(b.join_time || "1970-01-01").getTime() - new Date(a.join_time || "1970-01-01").getTime();
-        if (sort === "date_asc")
-            return new Date(a.join_time || "1970-01-01").getTime() - new Date(b.join_time || "1970-01-01").getTime();
-        return 0;
-    });
+    // Порядок задаёт сервер
+    const sortedUsers = filteredUsers;
 
     // Кнопка сортировки
     const SortButton = ({
@@ -683,6 +709,20 @@ const UsersAdmin: React.FC = () => {
                 </Box>
             )}
 
+            {/* Следующая страница */}
+            {!loading && nextCursor && (
+                <Box sx={{ display: "flex", justifyContent: "center", my: 3 }}>
+                    <Button
+                        onClick={fetchMoreUsers}
+                        disabled={loadingMore}
+                        variant="outlined"
+                        sx={{ borderRadius: 3, fontFamily: "Nunito" }}
+                    >
+                        {loadingMore ? <CircularProgress size={22}/> : "Показать ещё"}
+                    </Button>
+                </Box>
+            )}
+
             {/* Диалог изменения баланса */}
             <StyledDialog
                 open={editBalanceOpen}
@@ -178,6 +178,8 @@ export function Cart() {
                 items,
                 total_amount: totalPrice,
                 order_type: orderType,
+                // Ваза и секатор - отдельными позициями заказа, цену считает сервер
+                extras: (Object.keys(extra) as (keyof typeof extra)[]).filter(key => extra[key]),
                 fio,
                 phone,
                 email,
@@ -217,7 +219,7 @@ export function Cart() {
                 body: JSON.stringify({
                     user_id: userId,
                     order_id: orderId,
-                    amount: totalPrice,
+                    amount: orderData.total_amount,
                     description: "Оплата заказа",
                     return_url: window.location.origin + "/payment-success?order_id=" + orderId
                 })
@@ -166,7 +166,7 @@ export const CartProvider: React.FC<{ children: React.ReactNode }> = ({ children
             return;
         }
         try {
-            await axios.delete(`${API_URL}/cart_items?user_id=${userId}`, {
+            await axios.put(`${API_URL}/cart_items/bulk`, { user_id: userId, items: [] }, {
                 headers: { "ngrok-skip-browser-warning": "true" }
             });
             setCartItems([]);
@@ -6,9 +6,12 @@ from typing import Iterable
 # noinspection PyUnresolvedReferences
 import alembic_postgresql_enum
 from alembic import context
-from alembic.operations import MigrationScript
+from alembic.autogenerate import renderers
+from alembic.autogenerate.render import render_op
+from alembic.operations import MigrationScript, ops
 from alembic.runtime.migration import MigrationContext
-from sqlalchemy import pool
+from sqlalchemy import pool, String
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine import Connection
 from sqlalchemy.ext.asyncio import async_engine_from_config
 
@@ -62,6 +65,92 @@ def run_migrations_offline() -> None:
         context.run_migrations()
 
 
+def _cast_using(op: ops.AlterColumnOp) -> str | None:
+    if isinstance(op.modify_type, postgresql.JSONB) and isinstance(op.existing_type, String):
+        return f"NULLIF({op.column_name}, '')::jsonb"
+    if isinstance(op.modify_type, String) and isinstance(op.existing_type, postgresql.JSONB):
+        return f"{op.column_name}::text"
+    return None
+
+
+def add_type_casts(migration_ops: ops.UpgradeOps | ops.DowngradeOps) -> None:
+    """
+    Postgres does not cast varchar to jsonb implicitly and alembic does not
+    render postgresql_using, so such type changes are emitted as raw ALTER ... USING.
+    """
+    for table_ops in migration_ops.ops:
+        if not isinstance(table_ops, ops.ModifyTableOps):
+            continue
+        table_ops_list = []
+        for op in table_ops.ops:
+            using = _cast_using(op) if isinstance(op, ops.AlterColumnOp) else None
+            if using is None:
+                table_ops_list.append(op)
+                continue
+            type_ = op.modify_type.compile(dialect=postgresql.dialect())
+            table_ops_list.append(ops.ExecuteSQLOp(
+                f"ALTER TABLE {op.table_name} ALTER COLUMN {op.column_name} TYPE {type_} USING {using}"
+            ))
+            # Остальные изменения колонки (nullable, default, ...) оставляем alembic
+            op.modify_type = None
+            if op.has_changes():
+                table_ops_list.append(op)
+        table_ops.ops = table_ops_list
+
+
+def _iter_ops(migration_ops: ops.OpContainer):
+    for op in migration_ops.ops:
+        if isinstance(op, ops.OpContainer):
+            yield from _iter_ops(op)
+        else:
+            yield op
+
+
+def add_required_extensions(upgrade_ops: ops.UpgradeOps) -> None:
+    """Trigram indexes need the pg_trgm extension to exist before they are created."""
+    for op in _iter_ops(upgrade_ops):
+        if isinstance(op, ops.CreateIndexOp) and 'gin_trgm_ops' in op.kw.get('postgresql_ops', {}).values():
+            upgrade_ops.ops.insert(0, ops.ExecuteSQLOp("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            return
+
+
+class ConcurrentIndexOp(ops.MigrateOperation):
+    """CREATE/DROP INDEX CONCURRENTLY, rendered inside an autocommit block."""
+
+    def __init__(self, index_op: ops.CreateIndexOp | ops.DropIndexOp):
+        self.index_op = index_op
+
+    def reverse(self) -> 'ConcurrentIndexOp':
+        return ConcurrentIndexOp(self.index_op.reverse())
+
+
+@renderers.dispatch_for(ConcurrentIndexOp)
+def render_concurrent_index(autogen_context, op: ConcurrentIndexOp) -> list[str]:
+    # Пустая строка закрывает блок with, как в render_as_batch
+    return ['with op.get_context().autocommit_block():', *render_op(autogen_context, op.index_op), '']
+
+
+def build_indexes_concurrently(migration_ops: ops.UpgradeOps | ops.DowngradeOps) -> None:
+    """
+    Indexes on existing tables are built with CONCURRENTLY so that the migration does not block
+    writes to large tables. CONCURRENTLY cannot run inside a transaction, hence the autocommit block.
+    Tables created or dropped by the same migration are left as is.
+    """
+    new_tables = {
+        op.table_name for op in _iter_ops(migration_ops) if isinstance(op, (ops.CreateTableOp, ops.DropTableOp))
+    }
+
+    def wrap(container: ops.OpContainer) -> None:
+        for i, op in enumerate(container.ops):
+            if isinstance(op, ops.OpContainer):
+                wrap(op)
+            elif isinstance(op, (ops.CreateIndexOp, ops.DropIndexOp)) and op.table_name not in new_tables:
+                op.kw['postgresql_concurrently'] = True
+                container.ops[i] = ConcurrentIndexOp(op)
+
+    wrap(migration_ops)
+
+
 # noinspection PyUnusedLocal
 def process_revision_directives(
         context: MigrationContext,
@@ -75,6 +164,13 @@ def process_revision_directives(
         if script.upgrade_ops.is_empty():
             directives[:] = []
             logger.info('No changes found! Nothing to do.')
+            return
+
+        add_type_casts(script.upgrade_ops)
+        add_type_casts(script.downgrade_ops)
+        add_required_extensions(script.upgrade_ops)
+        build_indexes_concurrently(script.upgrade_ops)
+        build_indexes_concurrently(script.downgrade_ops)
 
 
 def do_run_migrations(connection: Connection) -> None:
@@ -2,7 +2,9 @@ from .admin import Admin
 from .base import Base
 from .cart_item import CartItem
 from .delivery import Delivery
+from .launch_batch import LaunchBatch
 from .order import Order
+from .order_item import OrderItem
 from .product import Product
 from .source import Source
 from .source_visit import SourceVisit
@@ -2,6 +2,7 @@ import enum
 from datetime import datetime
 
 from sqlalchemy import BigInteger, String, Integer, ForeignKey, DateTime
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship, mapped_column, Mapped
 from sqlalchemy.types import DECIMAL
 
@@ -20,7 +21,7 @@ class CartItem(Base):
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
 
-    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.user_id'))
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey('users.user_id'), index=True)
     item_id: Mapped[str] = mapped_column(String)
 
     quantity: Mapped[int] = mapped_column(Integer, default=1)
@@ -35,6 +36,6 @@ class CartItem(Base):
     subscriptionMonths: Mapped[int] = mapped_column(Integer, default=1, nullable=True)  # <-- добавить!
 
     title: Mapped[str] = mapped_column(String, default="")  # <-- добавить!
-    photos: Mapped[str] = mapped_column(String, default="[]")  # <-- добавить!
+    photos: Mapped[list[str]] = mapped_column(JSONB, default=list)
 
     user = relationship("User", back_populates="cart_items", foreign_keys=[user_id])
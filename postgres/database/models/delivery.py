@@ -1,4 +1,4 @@
-from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey
+from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, Index, text
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -6,10 +6,20 @@ from .base import Base
 
 class Delivery(Base):
     __tablename__ = 'deliveries'
+    __table_args__ = (
+        # Календарь доставок за период
+        Index('ix_deliveries_delivery_date_status', 'delivery_date', 'status'),
+        # Доставки, о которых ещё не напомнили клиенту
+        Index(
+            'ix_deliveries_reminder_due', 'delivery_date',
+            postgresql_where=text("status = 'scheduled' AND reminder_sent_at IS NULL")
+        ),
+    )
 
     id = Column(BigInteger, primary_key=True)
-    order_id = Column(BigInteger, ForeignKey('orders.id'))
+    order_id = Column(BigInteger, ForeignKey('orders.id'), index=True)
 
     delivery_date = Column(DateTime)
     status = Column(String, default='scheduled')  # "scheduled", "delivered", "canceled"
+    reminder_sent_at = Column(DateTime, nullable=True)  # Когда клиенту напомнили о доставке
     order = relationship("Order", back_populates="deliveries", foreign_keys=[order_id])
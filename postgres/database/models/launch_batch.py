@@ -0,0 +1,11 @@
+from sqlalchemy import Column, String, DateTime, func
+
+from .base import Base
+
+
+class LaunchBatch(Base):
+    """Применённые пачки счётчиков запусков и дневные сбросы - чтобы повтор после сбоя не применил их дважды."""
+    __tablename__ = 'launch_batches'
+
+    id = Column(String, primary_key=True)  # uuid пачки или reset:<день>
+    applied_at = Column(DateTime, default=func.now(), nullable=False)
@@ -1,24 +1,30 @@
-from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, func
+from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, func, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.types import DECIMAL
 
 from .base import Base
 from .delivery import Delivery
+from .order_item import OrderItem
 
 
 class Order(Base):
     __tablename__ = 'orders'
+    __table_args__ = (
+        # История заказов пользователя, новые первыми, keyset-пагинация по (created_at, id)
+        Index('ix_orders_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
 
     id = Column(BigInteger, primary_key=True)
 
     user_id = Column(BigInteger, ForeignKey('users.user_id'))
-    status = Column(String, default='pending')
+    status = Column(String, default='pending', index=True)
     total_amount = Column(DECIMAL(precision=10, scale=2))
 
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, onupdate=func.now())
 
-    items = Column(String, nullable=True)  # json, OMG
+    items = Column(JSONB(none_as_null=True), nullable=True)  # Устарело: list[dict] позиций, теперь в order_items
     order_type = Column(String, default='one-time')  # <-- добавлено!
 
     fio = Column(String, nullable=True)  # <-- Добавить
@@ -30,3 +36,7 @@ class Order(Base):
     transactions = relationship("Transaction", back_populates="order", foreign_keys="Transaction.order_id")
 
     deliveries = relationship("Delivery", back_populates="order", foreign_keys=[Delivery.order_id])
+    order_items = relationship(
+        "OrderItem", back_populates="order", foreign_keys=[OrderItem.order_id], order_by=OrderItem.position,
+        cascade="all, delete-orphan", passive_deletes=True
+    )
@@ -0,0 +1,21 @@
+from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, Integer
+from sqlalchemy.orm import relationship
+
+from .base import Base
+
+
+class OrderItem(Base):
+    __tablename__ = 'order_items'
+
+    id = Column(BigInteger, primary_key=True)
+    order_id = Column(BigInteger, ForeignKey('orders.id', ondelete='CASCADE'), nullable=False, index=True)
+    position = Column(Integer, nullable=False, default=0)  # Порядок позиций в заказе
+
+    product_id = Column(BigInteger, nullable=False, index=True)  # 0 - доставка и дополнительные позиции
+    title = Column(String, nullable=True)
+    price = Column(Integer, nullable=False)
+    deliveries_per_month = Column(Integer, nullable=True)
+    subscription_months = Column(Integer, nullable=True)
+    delivery_date = Column(DateTime, nullable=True)
+
+    order = relationship("Order", back_populates="order_items", foreign_keys=[order_id])
@@ -1,16 +1,28 @@
-from sqlalchemy import Column, BigInteger, String, Integer
+from sqlalchemy import Column, BigInteger, String, Integer, Index, Computed
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.orm import deferred
 
 from .base import Base
 
 
 class Product(Base):
     __tablename__ = 'products'
+    __table_args__ = (
+        # Фильтры каталога + keyset-пагинация по (цене, id)
+        Index('ix_products_type_price_id', 'type', 'price_per_delivery', 'id'),
+        Index('ix_products_type_size_price_id', 'type', 'size', 'price_per_delivery', 'id'),
+        Index('ix_products_price_id', 'price_per_delivery', 'id'),
+        # Поиск: полнотекстовый по названию и описанию + нечёткий по названию (pg_trgm)
+        Index('ix_products_search_vector', 'search_vector', postgresql_using='gin'),
+        Index('ix_products_title_trgm', 'title', postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}),
+    )
 
     id = Column(BigInteger, primary_key=True)
     title = Column(String, nullable=False)
     description = Column(String, nullable=True)
 
-    photos = Column(String, nullable=True)
+    photos = Column(JSONB(none_as_null=True), nullable=True)  # list[str]
+    thumbnails = Column(JSONB(none_as_null=True), nullable=True)  # {photo_url: {width: {format: url}}}
     price_per_delivery = Column(Integer, nullable=False)
 
     max_deliveries = Column(Integer, nullable=False)
@@ -18,3 +30,9 @@ class Product(Base):
 
     type = Column(String, nullable=False)
     size = Column(String, nullable=True)  # S, M, L
+
+    # Нужен только для поиска, поэтому не загружается вместе с товаром
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "to_tsvector('russian', coalesce(title, '') || ' ' || coalesce(description, ''))",
+        persisted=True
+    )))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, func
+from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, func, Index
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -6,6 +6,10 @@ from .base import Base
 
 class SourceVisit(Base):
     __tablename__ = 'source_visits'
+    __table_args__ = (
+        # Визиты источника и проверка повторного визита пользователя
+        Index('ix_source_visits_source_id_user_id', 'source_id', 'user_id'),
+    )
 
     id = Column(BigInteger, primary_key=True)
 
@@ -9,7 +9,7 @@ class Transaction(Base):
 
     id = Column(BigInteger, primary_key=True)
 
-    user_id = Column(BigInteger, ForeignKey('users.user_id'))
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), index=True)
     order_id = Column(BigInteger, ForeignKey('orders.id'), nullable=True)  # <-- Связь с заказом!
 
     amount = Column(DECIMAL(precision=10, scale=2))
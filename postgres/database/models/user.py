@@ -1,4 +1,5 @@
-from sqlalchemy import Column, BigInteger, String, DateTime, func, DECIMAL, Integer, ForeignKey, Boolean
+from sqlalchemy import Column, BigInteger, String, DateTime, func, DECIMAL, Integer, ForeignKey, Boolean, Index, literal_column, \
+    Computed
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -6,12 +7,31 @@ from .base import Base
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Фильтр по источнику в админке + keyset-пагинация по id
+        Index('ix_users_source_param_id', 'source_param', 'id'),
+        # Поиск по телефону в админке: по началу номера (btree) и по любой его части (pg_trgm)
+        Index('ix_users_phone_digits_prefix', 'phone_digits', postgresql_ops={'phone_digits': 'text_pattern_ops'}),
+        Index('ix_users_phone_digits_trgm', 'phone_digits', postgresql_using='gin',
+              postgresql_ops={'phone_digits': 'gin_trgm_ops'}),
+    )
 
     id = Column(BigInteger, primary_key=True)
 
     user_id = Column(BigInteger, unique=True)
     username = Column(String, nullable=True)
     phone_number = Column(String)
+    # Только цифры номера, 8XXXXXXXXXX и 9XXXXXXXXX приводятся к 7XXXXXXXXXX, как в format_phone
+    phone_digits = Column(String, Computed(
+        "CASE"
+        " WHEN regexp_replace(phone_number, '[^0-9]', '', 'g') ~ '^8[0-9]{10}$'"
+        " THEN '7' || substr(regexp_replace(phone_number, '[^0-9]', '', 'g'), 2)"
+        " WHEN regexp_replace(phone_number, '[^0-9]', '', 'g') ~ '^9[0-9]{9}$'"
+        " THEN '7' || regexp_replace(phone_number, '[^0-9]', '', 'g')"
+        " ELSE nullif(regexp_replace(phone_number, '[^0-9]', '', 'g'), '')"
+        " END",
+        persisted=True
+    ))
     avatar = Column(String, nullable=True)
     join_time = Column(DateTime, default=func.now())
     first_name = Column(String, nullable=True)
@@ -32,3 +52,15 @@ class User(Base):
     orders = relationship("Order", back_populates="user", foreign_keys="Order.user_id")
 
     source_param = Column(String, nullable=True)  # Добавь это поле
+
+
+# Ключи сортировки списка пользователей в админке. NULL заменены константами, чтобы keyset-курсор
+# (ключ, id) сравнивался корректно; константы не параметры, иначе выражение не совпадёт с индексом
+USER_SORT_KEYS = {
+    'join_time': func.coalesce(User.join_time, literal_column("'1970-01-01 00:00:00'::timestamp")),
+    'balance': func.coalesce(User.balance, literal_column('0')),
+    'total_launches': func.coalesce(User.total_launches, literal_column('0')),
+}
+
+for _name, _key in USER_SORT_KEYS.items():
+    Index(f'ix_users_{_name}_id', _key, User.id)
@@ -1,10 +1,15 @@
-from sqlalchemy import Column, BigInteger, String, DateTime, func
+from sqlalchemy import Column, BigInteger, String, DateTime, func, Index
+from sqlalchemy.dialects.postgresql import JSONB
 
 from .base import Base
 
 
 class UserActionLog(Base):
     __tablename__ = 'user_action_logs'
+    __table_args__ = (
+        # Действия пользователя и воронка источников: user_id + action, новые первыми
+        Index('ix_user_action_logs_user_id_action_timestamp', 'user_id', 'action', 'timestamp'),
+    )
 
     id = Column(BigInteger, primary_key=True)
 
@@ -12,5 +17,5 @@ class UserActionLog(Base):
     phone_number = Column(String, nullable=True)
 
     action = Column(String, nullable=False)  # Например: "enter_bot", "submit_phone", "open_miniapp", "add_to_cart", "payment"
-    data = Column(String, nullable=True)  # JSON/dict для дополнительных деталей
+    data = Column(JSONB(none_as_null=True), nullable=True)  # dict для дополнительных деталей
     timestamp = Column(DateTime, default=func.now())